@@ -1,55 +1,116 @@
 # Library implementation of Falcom's Mode 3 (C77) and Mode 2 (BZ) algorithms.
 # Thank you to Twnkey, uyjulian and Kyuuhachi (Aureole-Suite)!
 # Usage:  Decompress with parse_data_blocks (f), compress with create_data_blocks (content, mode)
+# To stream, use iter_data_blocks (f) or decompress_into (f, buffer) instead of parse_data_blocks.
+# To decompress only part of the data, use read_range (f, start, length).
+# To decompress many containers at once, hand them to submit_decompression (payload, count).
+# Call set_decompression_workers (n) / set_compression_workers (n) to use more than one process.
 #
 # GitHub eArmada8/Ys8_IT3
 
-import struct, io, array
+import struct, io, array, os, time, bisect, re, hashlib
+from concurrent.futures import ProcessPoolExecutor, Future
+from functools import partial
+
+# Number of processes used to compress independent segments / chunks.  Leave at 1 to compress
+# everything in this process, or change with set_compression_workers() (0 uses every core).
+compression_workers = 1
+compression_pool = None
+# Number of processes used to decompress the blocks of a multi-block C77 container, change with
+# set_decompression_workers() (0 uses every core).
+decompression_workers = 1
+decompression_pool = None
+# 1 compresses normally.  0 stores the data without compressing it, for quick test builds: C77 gets
+# uncompressed blocks and BZ mode 2 gets a stream of literals.  2 uses the (much slower) optimal parsers
+# for the smallest output, and keeps count of the greedy output size for take_ratio_report().  Change
+# with set_compression_level().
+compression_level = 1
+max_ratio_greedy_bytes = 0
+max_ratio_bytes = 0
+# Folder to keep compressed segments in between runs, off (None) unless set with set_block_cache().
+# Bump COMPRESSOR_VERSION whenever the compressors change their output, so old entries are not reused.
+COMPRESSOR_VERSION = 3
+block_cache_folder = None
+block_cache_max_size = 256 * 1024 * 1024
+block_cache_size = None # Counted on first use
 
 # C77 type 1 aka FALCOM3, thank you to TwnKey
+# The block is read in one go and walked by index.  Back-references that do not overlap the bytes they
+# produce are copied as a single slice, overlapping ones repeat the last (distance) bytes, so they are
+# built by repeating that pattern.
 def parse_data_block_c77_1 (f, block_size, uncompressed_block_size, is_compressed):
     if is_compressed:
+        src = f.read(block_size - 4)
         contents = bytearray(uncompressed_block_size)
-        start = f.tell()
         i = 0
-        while f.tell() < start + block_size - 4:
-            current_byte1, current_byte2 = struct.unpack("<2B", f.read(2))
+        pos = 0
+        end = len(src)
+        while pos < end:
+            current_byte1 = src[pos]
+            current_byte2 = src[pos+1]
             if (current_byte1 == 0):
-                contents[i:i+current_byte2] = f.read(current_byte2)
-                i = i + current_byte2
+                pos += 2
+                contents[i:i+current_byte2] = src[pos:pos+current_byte2]
+                i += current_byte2
+                pos += current_byte2
             else:
-                for _ in range(current_byte1):
-                    contents[i] = contents[i-1-current_byte2]
-                    i = i + 1
-                contents[i:i+1] = f.read(1)
-                i = i + 1
+                start = i - current_byte2 - 1
+                if current_byte1 <= current_byte2 + 1:
+                    contents[i:i+current_byte1] = contents[start:start+current_byte1]
+                else: # Repeat the last (distance) bytes, bytes * n is expanded by doubling internally
+                    contents[i:i+current_byte1] = (contents[start:i] * (current_byte1 // (current_byte2 + 1) + 1))[:current_byte1]
+                i += current_byte1
+                if pos + 2 < end: # The last match of a block may have no literal after it
+                    contents[i] = src[pos+2]
+                    i += 1
+                pos += 3
     else:
         contents = f.read(block_size - 4)
     return(contents)
 
 # C77 type 2, thank you to Kyuuhachi (Aureole-Suite/Falcompress)
+# Parsed out of an in-memory copy of the block into a preallocated buffer.  Matches are copied as slices,
+# and matches longer than their distance are built by repeating the last (dist) bytes.
 def parse_data_block_c77_2 (f, block_size, uncompressed_block_size):
-    def read_len(f, v):
-        len_ = v
-        if v == 15:
+    src = f.read(block_size)
+    end = len(src)
+    unc_data = bytearray(uncompressed_block_size)
+    i = 0
+    pos = 0
+    while pos < end:
+        h = src[pos]
+        pos += 1
+        len_ = h >> 4
+        if len_ == 15:
             while True:
-                n, = struct.unpack("<B", f.read(1))
+                n = src[pos]
+                pos += 1
                 len_ += n
                 if not n == 255:
                     break
-        return(len_)
-    end_of_block = f.tell() + block_size
-    unc_data = bytearray()
-    while f.tell() < end_of_block:
-        h, = struct.unpack("<B", f.read(1))
-        len_ = read_len(f, h >> 4)
-        unc_data.extend(f.read(len_))
-        if f.tell() >= end_of_block:
+        unc_data[i:i+len_] = src[pos:pos+len_]
+        i += len_
+        pos += len_
+        if pos >= end:
             break
-        dist, = struct.unpack("<H", f.read(2))
-        len_ = read_len(f, h & 0xF) + 4
-        for _ in range(len_):
-            unc_data.append(unc_data[-dist])
+        dist = src[pos] | (src[pos+1] << 8)
+        pos += 2
+        len_ = h & 0xF
+        if len_ == 15:
+            while True:
+                n = src[pos]
+                pos += 1
+                len_ += n
+                if not n == 255:
+                    break
+        len_ += 4
+        start = i - dist
+        if len_ <= dist:
+            unc_data[i:i+len_] = unc_data[start:start+len_]
+        else: # Repeat the last (dist) bytes, bytes * n is expanded by doubling internally
+            unc_data[i:i+len_] = (unc_data[start:i] * (len_ // dist + 1))[:len_]
+        i += len_
+    del unc_data[i:]
     return(unc_data)
 
 # Thank you to uyjulian, source: https://gist.github.com/uyjulian/a6ba33dc29858327ffa0db57f447abe5
@@ -147,31 +208,197 @@ def decompress(buffer, output, size):
             offset += 1
     return outputoffset, offset
 
-# Accepts a byte stream (e.g. open file handle or BytesIO object)
-def parse_data_blocks (f):
+# Lookup tables for decompress_mode2.  Flags are consumed lowest bit first, but multi-bit fields are
+# assembled highest bit first, so n flags read at once have to be bit-reversed.
+BZ_REVERSED_BITS = [[int(format(v, '0{}b'.format(n))[::-1], 2) if n > 0 else 0 for v in range(1 << n)] for n in range(9)]
+# Run length prefix code, indexed by the next 5 flags: (run length, flags used).  A run length of 0 means
+# three more flags follow (run of 6-13), and 1 means the run length is in the next byte (run of 14-269).
+BZ_RUN_CODES = [(2, 1) if v & 1 else (3, 2) if v & 2 else (4, 3) if v & 4 else (5, 4) if v & 8\
+    else (0, 5) if v & 16 else (1, 5) for v in range(32)]
+
+# Same format as decompress above, decoded with the flags held in a local integer.  The flag word is only
+# refilled when it runs empty, exactly as the game does, since refills and data bytes share one stream.
+# Runs of literal bytes and back-references are copied as slices.
+def decompress_mode2(buffer, output, size):
+    def read_flags(n):
+        nonlocal flags, bits, offset
+        if bits >= n:
+            value = BZ_REVERSED_BITS[n][flags & ((1 << n) - 1)]
+            flags >>= n
+            bits -= n
+            return(value)
+        # Use up what is left, refill, then take the rest (high bits first)
+        high = BZ_REVERSED_BITS[bits][flags]
+        n -= bits
+        flags = buffer[offset] | (buffer[offset + 1] << 8)
+        offset += 2
+        value = (high << n) | BZ_REVERSED_BITS[n][flags & ((1 << n) - 1)]
+        flags >>= n
+        bits = 16 - n
+        return(value)
+    def copy_run(distance):
+        nonlocal flags, bits, offset, outputoffset
+        if bits >= 5:
+            run, used = BZ_RUN_CODES[flags & 0x1F]
+            flags >>= used
+            bits -= used
+        else:
+            run = 2
+            for code in (3, 4, 5, None):
+                if read_flags(1):
+                    break
+                elif code is None:
+                    run = 0 if read_flags(1) else 1
+                else:
+                    run = code
+        if run == 0:
+            run = read_flags(3) + 0x6
+        elif run == 1:
+            run = buffer[offset] + 0xE
+            offset += 1
+        start = outputoffset - distance
+        if distance == 0: # decompress copies each byte onto itself here, which leaves a fresh buffer zeroed
+            output[outputoffset:outputoffset + run] = bytes(run)
+        elif run <= distance:
+            output[outputoffset:outputoffset + run] = output[start:start + run]
+        else:
+            output[outputoffset:outputoffset + run] = (output[start:outputoffset] * (run // distance + 1))[:run]
+        outputoffset += run
+        return
+    offset = 2
+    flags = buffer[1] # The first byte only carries the method, the second is the first 8 flags
+    bits = 8
+    outputoffset = 0
+    try:
+        while True:
+            if bits == 0:
+                flags = buffer[offset] | (buffer[offset + 1] << 8)
+                offset += 2
+                bits = 16
+            if flags & 1 == 0: # Copy bytes, one for every consecutive 0 flag that is already loaded
+                literals = min(bits, (flags & -flags).bit_length() - 1) if flags else bits
+                if offset + literals > len(buffer):
+                    raise IndexError
+                output[outputoffset:outputoffset + literals] = buffer[offset:offset + literals]
+                outputoffset += literals
+                offset += literals
+                flags >>= literals
+                bits -= literals
+            elif read_flags(2) == 0b11: # Long look-back distance or exit program or repeating sequence
+                high = read_flags(5)
+                low = buffer[offset]
+                offset += 1
+                if high != 0:
+                    copy_run(low | (high << 8))
+                elif low > 2:
+                    copy_run(low)
+                elif low == 0: # Decompression complete
+                    break
+                else: # Repeating byte
+                    branch = read_flags(1)
+                    run = read_flags(4)
+                    if branch != 0:
+                        run = (run << 0x8) | buffer[offset]
+                        offset += 1
+                    run += 0xE
+                    output[outputoffset:outputoffset + run] = buffer[offset:offset + 1] * run
+                    offset += 1
+                    outputoffset += run
+            else: # Short look-back distance (flags = 10)
+                distance = buffer[offset]
+                offset += 1
+                copy_run(distance)
+    except IndexError:
+        raise Exception("Out of data")
+    return outputoffset, offset
+
+# Decodes one entry of the C77 block table built by iter_data_blocks.  Takes a single tuple so that it
+# can be handed to a worker process.
+def parse_indexed_block_c77 (block):
+    c77_type, block_size, uncompressed_block_size, is_compressed, payload = block
+    with io.BytesIO(payload) as f:
+        if c77_type == 1:
+            return(parse_data_block_c77_1(f, block_size, uncompressed_block_size, is_compressed))
+        else:
+            return(parse_data_block_c77_2(f, block_size, uncompressed_block_size))
+
+def set_decompression_workers (workers):
+    global decompression_workers, decompression_pool
+    if decompression_pool is not None:
+        decompression_pool.shutdown()
+        decompression_pool = None
+    decompression_workers = max(1, workers if workers > 0 else (os.cpu_count() or 1))
+    return
+
+# Worker processes decode everything they are handed themselves, rather than starting pools of their own
+def init_decompression_worker ():
+    global decompression_workers, decompression_pool
+    decompression_workers = 1
+    decompression_pool = None
+    return
+
+# Returns the decompression process pool, or None if set_decompression_workers() has not asked for one
+def get_decompression_pool ():
+    global decompression_pool
+    if decompression_workers > 1 and decompression_pool is None:
+        decompression_pool = ProcessPoolExecutor(max_workers = decompression_workers,\
+            initializer = init_decompression_worker)
+    return(decompression_pool)
+
+# Decompresses count containers stored back to back in payload, and returns the data joined together.
+# Takes a single tuple so that it can be handed to a worker process.
+def parse_data_blocks_from (job):
+    payload, count = job
+    with io.BytesIO(payload) as f:
+        return(b''.join([parse_data_blocks(f) for i in range(count)]))
+
+# Starts decompressing count back-to-back containers (copied out of the file beforehand, see
+# read_data_blocks_compressed) and returns a Future for the data.  With a single decompression worker the data is
+# decompressed straight away, but it is still returned as a Future so that callers need only one code path.
+def submit_decompression (payload, count = 1):
+    pool = get_decompression_pool()
+    if pool is None:
+        future = Future()
+        future.set_result(parse_data_blocks_from((payload, count)))
+        return(future)
+    return(pool.submit(parse_data_blocks_from, (payload, count)))
+
+# Accepts a byte stream (e.g. open file handle or BytesIO object), and yields the decompressed data one
+# block at a time as it is decoded.  The stream is read lazily, so do not move f until the generator is done.
+def iter_data_blocks (f):
     # Larger data blocks are segmented prior to compression, not really sure what the rules are here
     # compressed_size and segment_size are 8 bytes larger than block_size for header?  uncompressed_size is true
     # size without any padding, as is uncompressed_block_size
     flags, = struct.unpack("<I", f.read(4))
     if flags & 0x80000000:
         num_blocks, compressed_size, segment_size, uncompressed_size = struct.unpack("<4I", f.read(16))
-        data = bytes()
+        if not flags & 0x7FFFFFFF in [1, 2]:
+            print("Unknown C77 type!")
+            return
+        if decompression_workers > 1 and num_blocks > 1:
+            # Every block is compressed independently, so read the whole block table and decode in parallel
+            block_table = []
+            for i in range(num_blocks):
+                block_size, uncompressed_block_size = struct.unpack("<2I", f.read(8))
+                if flags & 0x7FFFFFFF == 1: # C77 mode 1
+                    block_type, = struct.unpack("<I", f.read(4))
+                    block_table.append((1, block_size, uncompressed_block_size, (block_type == 8), f.read(block_size - 4)))
+                else: # C77 mode 2
+                    block_table.append((2, block_size, uncompressed_block_size, False, f.read(block_size)))
+            yield from get_decompression_pool().map(parse_indexed_block_c77, block_table)
+            return
         for i in range(num_blocks):
             block_size, uncompressed_block_size = struct.unpack("<2I", f.read(8))
             if flags & 0x7FFFFFFF == 1: # C77 mode 1
                 block_type, = struct.unpack("<I", f.read(4))
                 is_compressed = (block_type == 8)
-                data += parse_data_block_c77_1(f, block_size, uncompressed_block_size, is_compressed)
-            elif flags & 0x7FFFFFFF == 2: # C77 mode 2
-                data += parse_data_block_c77_2(f, block_size, uncompressed_block_size)
-            else:
-                print("Unknown C77 type!")
-                return b''
+                yield parse_data_block_c77_1(f, block_size, uncompressed_block_size, is_compressed)
+            else: # C77 mode 2
+                yield parse_data_block_c77_2(f, block_size, uncompressed_block_size)
     else: # Thank you to uyjulian, source: https://gist.github.com/uyjulian/a6ba33dc29858327ffa0db57f447abe5
         dst_offset = 0
         compressed_size = flags
         uncompressed_size, num_blocks = struct.unpack("<2I", f.read(8))
-        dst = bytearray(uncompressed_size) # Should already be initialized with 0
         cdata = io.BytesIO(f.read(compressed_size - 8))
         for i in range(num_blocks):
             block_size = struct.unpack("<H", cdata.read(2))[0]
@@ -179,8 +406,8 @@ def parse_data_blocks (f):
             inbuf = cdata.read(block_size - 2)
             if inbuf[0] != 0:
                 raise Exception("Non-zero method currently not supported")
-            num1, num2 = decompress(inbuf, output_tmp, block_size)
-            dst[dst_offset:dst_offset + num1] = output_tmp[0:num1]
+            num1, num2 = decompress_mode2(inbuf, output_tmp, block_size)
+            yield output_tmp[0:num1]
             dst_offset += num1
             if dst_offset >= uncompressed_size:
                 break
@@ -189,62 +416,305 @@ def parse_data_blocks (f):
                 break
             if x[0] == 0:
                 break
-        data = bytes(dst)
-    return(data)
+        if dst_offset < uncompressed_size: # Short data is padded with zeros up to uncompressed_size
+            yield bytes(uncompressed_size - dst_offset)
+    return
 
-# My best attempt at recreating the Ys VIII compression algorithm (C77 aka FALCOM3).
-# Content should be a bytes-like object.
+# Decompresses into a caller-supplied bytearray / writable memoryview, starting at offset.  The buffer
+# must be large enough to hold the data.  Returns the number of bytes written.
+def decompress_into (f, buffer, offset = 0):
+    view = memoryview(buffer)
+    written = 0
+    for block in iter_data_blocks(f):
+        view[offset+written:offset+written+len(block)] = block
+        written += len(block)
+    return(written)
+
+# Accepts a byte stream (e.g. open file handle or BytesIO object)
+def parse_data_blocks (f):
+    return(b''.join(iter_data_blocks(f)))
+
+# Moves f past one compressed container without decompressing anything.  Multi-block C77 is walked one
+# block header at a time, BZ has its total size in the first field.
+def skip_data_blocks (f):
+    flags, = struct.unpack("<I", f.read(4))
+    if flags & 0x80000000:
+        num_blocks, compressed_size, segment_size, uncompressed_size = struct.unpack("<4I", f.read(16))
+        for i in range(num_blocks):
+            block_size, uncompressed_block_size = struct.unpack("<2I", f.read(8))
+            f.seek(block_size, 1)
+    else:
+        f.seek(flags, 1)
+    return
+
+# Returns the raw bytes of count back-to-back containers without decompressing them, leaving f after the last
+def read_data_blocks_compressed (f, count = 1):
+    start = f.tell()
+    for i in range(count):
+        skip_data_blocks(f)
+    end = f.tell()
+    f.seek(start)
+    return(f.read(end - start))
+
+# Returns length bytes of the decompressed data starting at start (shorter if the data ends first).
+# Multi-block C77 lists the size of every block, so blocks outside the range are seeked past instead of
+# decoded.  BZ has no such index, so it is decoded up to the end of the range.  Like parse_data_blocks,
+# f is left at the end of the container.
+def read_range (f, start, length):
+    end = start + length
+    container_start = f.tell()
+    flags, = struct.unpack("<I", f.read(4))
+    if flags & 0x80000000 and flags & 0x7FFFFFFF in [1, 2]:
+        num_blocks, compressed_size, segment_size, uncompressed_size = struct.unpack("<4I", f.read(16))
+        data = []
+        block_start = 0
+        for i in range(num_blocks):
+            block_size, uncompressed_block_size = struct.unpack("<2I", f.read(8))
+            block_end = block_start + uncompressed_block_size
+            if block_end <= start or block_start >= end:
+                f.seek(block_size, 1)
+            else:
+                if flags & 0x7FFFFFFF == 1: # C77 mode 1
+                    block_type, = struct.unpack("<I", f.read(4))
+                    block = parse_data_block_c77_1(f, block_size, uncompressed_block_size, (block_type == 8))
+                else: # C77 mode 2
+                    block = parse_data_block_c77_2(f, block_size, uncompressed_block_size)
+                data.append(block[max(start - block_start, 0):end - block_start])
+            block_start = block_end
+        return(b''.join(data))
+    else:
+        f.seek(container_start)
+        data = bytearray()
+        for block in iter_data_blocks(f):
+            data.extend(block)
+            if len(data) >= end:
+                break
+        f.seek(container_start)
+        skip_data_blocks(f)
+        return(bytes(data[start:end]))
+
+# C77 type 1 token limits, see parse_data_block_c77_1 above.  A back-reference copies up to 255 bytes
+# from up to 256 bytes behind, and is always followed by exactly one literal byte.
+C77_MAX_LITERAL = 255
+C77_MAX_MATCH = 255
+C77_MAX_DISTANCE = 256
+C77_MIN_MATCH = 3 # Also the length of the hash chain key
+# Speed limits for the greedy compressor (the optimal parse does not use them).  The chain search stops
+# after C77_MAX_CHAIN candidates or at the first match of C77_NICE_MATCH bytes, and only the end of a
+# match longer than C77_MAX_INSERT is added to the hash chains.  The inside of a long match mostly repeats
+# sequences that are already in the chains, and would push the older candidates out of C77_MAX_CHAIN.
+C77_MAX_CHAIN = 64
+C77_NICE_MATCH = 64
+C77_MAX_INSERT = 8
+
+# Mode 2 limits, see decompress_mode2 above.  Back-references copy 2 to 269 bytes from up to 0x1FFF bytes
+# behind, a repeated byte is written 14 to 4109 times.
+BZ_MAX_MATCH = 269
+BZ_MAX_DISTANCE = 0x1FFF
+BZ_MAX_REPEAT = 4109
+BZ_MAX_CHAIN = 256 # Candidates the optimal parse tries per position
+
+# Length of the common prefix of content[a:] and content[b:] (a < b), up to limit.  Overlapping
+# matches are fine, since the decoder copies one byte at a time out of its own output.  XORing the two
+# runs as big-endian integers puts the first differing byte in the highest set bit.
+def c77_match_length(content, a, b, limit):
+    diff = int.from_bytes(content[a:a+limit], 'big') ^ int.from_bytes(content[b:b+limit], 'big')
+    return(limit - (diff.bit_length() + 7) // 8)
+
+def c77_write_literals(result, content, start, end):
+    for i in range(start, end, C77_MAX_LITERAL):
+        chunk = content[i:min(i+C77_MAX_LITERAL, end)]
+        result.extend(struct.pack("<2B", 0, len(chunk)))
+        result.extend(chunk)
+    return
+
+# Minimum of cost[j] over i + lag <= j <= end, for the optimal parsers, which fill in cost from the end.
+# The running minima seen from the left end (always falling to the right) are kept, so that the minimum
+# up to any end is a single bisect.  Call step (i) for every i in descending order before querying.
+class SuffixMinima:
+    def __init__(self, cost, lag):
+        self.cost = cost
+        self.lag = lag
+        self.indices = [] # Negated, so that they ascend
+        self.values = []
+    def step(self, i):
+        j = i + self.lag
+        if j < len(self.cost):
+            while len(self.values) > 0 and self.values[-1] >= self.cost[j]:
+                self.values.pop()
+                self.indices.pop()
+            self.values.append(self.cost[j])
+            self.indices.append(-j)
+        return
+    def query(self, end):
+        k = bisect.bisect_left(self.indices, -end)
+        return(self.values[k], -self.indices[k])
+
+# Optimal parse for C77 type 1, for compression_level 2.  Every token has a fixed size (2 bytes plus the
+# literals, or 3 bytes for a back-reference and its trailing literal), so the smallest output is found
+# by working backwards from the end of the block: cost[i] is the fewest bytes needed to encode content[i:].
+# Any back-reference shorter than the longest one at a position is also available, so each position
+# only needs the longest match in the window, and every shorter length is checked with SuffixMinima.
+def compress_data_block_optimal(content):
+    content = bytes(content)
+    length = len(content)
+    match_len = array.array('i', [0]) * length
+    match_dist = array.array('i', [0]) * length
+    head = {}
+    head_get = head.get
+    prev = array.array('i', [-1]) * length
+    last_seen = {} # Last position of every byte and every pair of bytes, for matches too short to hash
+    # Runs of a single byte value fill the hash chains with candidates that all match equally far.  At a
+    # position with run_left bytes of its run to go, a candidate with the same byte matches as far as the
+    # shorter of the two runs, unless both runs end together and the bytes after them decide.  So instead
+    # of walking the chain, only the ends of the earlier runs of that byte are looked at.
+    run_end = array.array('i', [0]) * length
+    run_number = array.array('i', [0]) * length
+    runs = {}
+    for run in re.finditer(b'(.)\\1*', content, re.DOTALL):
+        byte_runs = runs.setdefault(content[run.start()], [])
+        run_end[run.start():run.end()] = array.array('i', [run.end()]) * (run.end() - run.start())
+        run_number[run.start():run.end()] = array.array('i', [len(byte_runs)]) * (run.end() - run.start())
+        byte_runs.append((run.start(), run.end()))
+    for i in range(length):
+        best_len, best_dist = 0, 0
+        limit = min(C77_MAX_MATCH, length - i - 1)
+        key = content[i:i+C77_MIN_MATCH]
+        run_left = run_end[i] - i
+        if limit >= C77_MIN_MATCH and run_left >= C77_MIN_MATCH:
+            byte_runs = runs[content[i]]
+            if byte_runs[run_number[i]][0] < i:
+                best_len, best_dist = min(run_left, limit), 1
+            for k in range(run_number[i] - 1, -1, -1):
+                run_start, end = byte_runs[k]
+                candidate = end - run_left
+                if i - candidate > C77_MAX_DISTANCE:
+                    break
+                if candidate >= run_start:
+                    if best_len < min(run_left, limit):
+                        best_len, best_dist = min(run_left, limit), i - candidate
+                    if run_left < limit:
+                        match_len_here = run_left + c77_match_length(content, end, i + run_left, limit - run_left)
+                        if match_len_here > best_len:
+                            best_len, best_dist = match_len_here, i - candidate
+        elif limit >= C77_MIN_MATCH:
+            candidate = head_get(key, -1)
+            while candidate >= 0 and i - candidate <= C77_MAX_DISTANCE:
+                if content[candidate+best_len] == content[i+best_len] and\
+                        content[candidate:candidate+best_len] == content[i:i+best_len]:
+                    match_len_here = c77_match_length(content, candidate, i, limit)
+                    if match_len_here > best_len:
+                        best_len, best_dist = match_len_here, i - candidate
+                        if best_len == limit:
+                            break
+                candidate = prev[candidate]
+        for short_len in [2, 1]:
+            if best_len == 0 and limit >= short_len:
+                candidate = last_seen.get(content[i:i+short_len], -C77_MAX_DISTANCE - 1)
+                if i - candidate <= C77_MAX_DISTANCE:
+                    best_len, best_dist = short_len, i - candidate
+        match_len[i], match_dist[i] = best_len, best_dist
+        prev[i] = head_get(key, -1)
+        head[key] = i
+        last_seen[content[i:i+1]] = i
+        last_seen[content[i:i+2]] = i
+    cost = [0] * (length + 1)
+    literal_cost = list(range(length + 1)) # i + cost[i], so that a literal run from i to j costs 2 + literal_cost[j] - i
+    choice = array.array('i', [0]) * length # Length of the back-reference, or minus the length of the literal run
+    literals = SuffixMinima(literal_cost, 1)
+    matches = SuffixMinima(cost, 2)
+    for i in range(length - 1, -1, -1):
+        literals.step(i)
+        matches.step(i)
+        value, j = literals.query(min(length, i + C77_MAX_LITERAL))
+        best, best_choice = 2 + value - i, i - j
+        if match_len[i] > 0:
+            value, j = matches.query(i + match_len[i] + 1)
+            if 3 + value < best:
+                best, best_choice = 3 + value, j - i - 1
+        cost[i] = best
+        literal_cost[i] = i + best
+        choice[i] = best_choice
+    result = bytearray()
+    i = 0
+    while i < length:
+        if choice[i] > 0:
+            result.extend(struct.pack("<3B", choice[i], match_dist[i] - 1, content[i + choice[i]]))
+            i += choice[i] + 1
+        else:
+            result.extend(struct.pack("<2B", 0, -choice[i]))
+            result.extend(content[i:i-choice[i]])
+            i -= choice[i]
+    return(bytes(result))
+
+# Recreation of the Ys VIII compression algorithm (C77 aka FALCOM3), using hash chains to find matches.
+# head maps each 3-byte sequence to the last position it was seen at, and prev links every position to
+# the previous occurrence of its own 3-byte sequence, so only true candidates inside the 256-byte
+# window are ever compared.  Content should be a bytes-like object.
 def compress_data_block(content):
-    #print("Compressing data block.")
-    result = bytes()
-    offset = 0 # First byte of search buffer, anything behind this is already copied to result
-    window = 1 # First byte of look-ahead buffer
-    if len(content) > 2:
-        while window < len(content):
-            if content.find(content[window], offset, window) != -1:
-                byte_matches = [x for x in range(offset, window) if content[x] == content[window]]
-                for i in range(len(byte_matches)):
-                    if content[byte_matches[i]:window] == content[window:(window*2-byte_matches[i])]:
-                        len_repeat = window - byte_matches[i]
-                        num_repeats = 1
-                        while content[byte_matches[i]:window] ==\
-                            content[window + (num_repeats * len_repeat):(window*2-byte_matches[i]) + (num_repeats * len_repeat)]:
-                            num_repeats += 1
-                        num_repeats = min(num_repeats, 255 // len_repeat)
-                        if window + len_repeat * num_repeats >= len(content):
-                            num_repeats -= 1 # Compressed sequence cannot end on a repeat
-                        if len_repeat * num_repeats > 1: # Do not compress doublet bytes, which increase file size
-                            result += struct.pack("<2B", 0, (window-offset)) + content[offset:window] +\
-                                struct.pack("<2B", len_repeat * num_repeats, len_repeat - 1)
-                            offset = window + len_repeat * num_repeats
-                            window = offset + 1 
-                            result += content[offset:window]
-                            offset += 1
+    content = bytes(content)
+    length = len(content)
+    result = bytearray()
+    head = {}
+    head_get = head.get
+    prev = array.array('i', [-1]) * length
+    literal_start = 0 # Anything behind this is already copied to result
+    i = 0
+    while i < length:
+        key = content[i:i+C77_MIN_MATCH]
+        candidate = head_get(key, -1)
+        prev[i] = candidate
+        head[key] = i
+        if i - candidate > C77_MAX_DISTANCE: # Also true when there is no candidate at all
+            i += 1
+            continue
+        best_len, best_dist = 0, 0
+        # A match must leave at least one byte behind for the literal that follows it
+        limit = min(C77_MAX_MATCH, length - i - 1)
+        if limit >= C77_MIN_MATCH:
+            nice_len = min(C77_NICE_MATCH, limit)
+            chain = C77_MAX_CHAIN
+            while candidate >= 0 and i - candidate <= C77_MAX_DISTANCE and chain > 0:
+                # Skip candidates that cannot beat the current best before measuring them
+                if content[candidate:candidate+best_len+1] == content[i:i+best_len+1]:
+                    match_len = c77_match_length(content, candidate, i, limit)
+                    if match_len > best_len:
+                        best_len, best_dist = match_len, i - candidate
+                        if best_len >= nice_len:
                             break
-            if window - offset >= 255: # In actuality, window == 255 is fine
-                result += struct.pack("<2B", 0, 255) + content[offset:window]
-                offset = window
-            #if (window % (len(content) // 5) == 0):
-                #print("Progress: {0}%".format(round(window * 10 // (len(content)))*10))
-            window += 1
-        if offset < len(content):
-            result += struct.pack("<2B", 0, (window-offset)) + content[offset:window]
-    else:
-        result = content
-    return(result)
+                candidate = prev[candidate]
+                chain -= 1
+        if best_len >= C77_MIN_MATCH:
+            c77_write_literals(result, content, literal_start, i)
+            result.extend(struct.pack("<3B", best_len, best_dist - 1, content[i + best_len]))
+            for j in range(i + 1 if best_len <= C77_MAX_INSERT else i + best_len - 2, i + best_len + 1):
+                key = content[j:j+C77_MIN_MATCH]
+                prev[j] = head_get(key, -1)
+                head[key] = j
+            i += best_len + 1
+            literal_start = i
+        else:
+            i += 1
+    c77_write_literals(result, content, literal_start, length)
+    return(bytes(result))
 
 # Source: github.com/Aureole-Suite/Falcompress, thank you to Kyuuhachi
-def compress_mode2(input_):
+def compress_mode2(input_, optimal = False):
+    input_ = bytes(input_)
+    view = memoryview(input_)
+    # Compares input_[a:] against input_[b:] in place, looking at no more than limit bytes.  Keeps the
+    # original slice-based behaviour, where a run that only stops at the end of the input counts one short.
     def count_equal (a, b, limit = 4096):
-        aa = a[:limit]
-        bb = b[:limit]
-        if aa == bb:
-            return(len(aa))
-        count = 0
-        for count in range(min(len(aa),len((bb)))):
-            if aa[count] != bb[count]:
-                break
-        return count
+        len_a = max(0, min(limit, len(input_) - a))
+        len_b = max(0, min(limit, len(input_) - b))
+        count = min(len_a, len_b)
+        diff = int.from_bytes(view[a:a+count], 'big') ^ int.from_bytes(view[b:b+count], 'big')
+        if diff:
+            return(count - (diff.bit_length() + 7) // 8)
+        elif len_a == len_b:
+            return(count)
+        else:
+            return(max(0, count - 1))
     class Digraphs:
         def __init__(self, input_):
             self.input_ = input_ # The data to be compressed
@@ -252,36 +722,42 @@ def compress_mode2(input_):
             self.head = array.array('H', [0xFFFF]*0x10000)
             self.next_ = array.array('H', [0xFFFF]*0x2000)
             self.tail = array.array('H', [0xFFFF]*0x10000)
-        def digraph(self, pos):
-            if pos < len(self.input_):
-                if pos + 1 < len(self.input_):
-                    value, = struct.unpack('<H', self.input_[pos:pos+2])
-                else:
-                    value = self.input_[pos] # Returns an int
-                return (value)
-            else:
-                return False
+            # Little-endian u16 at every position, the last byte pairs with zero and anything past the end is 0
+            padded = input_ + b'\x00\x00\x00'
+            half = (len(input_) + 2) // 2
+            self.keys = array.array('H', [0]) * (half * 2)
+            self.keys[0::2] = array.array('H', struct.unpack("<{}H".format(half), padded[0:half*2]))
+            self.keys[1::2] = array.array('H', struct.unpack("<{}H".format(half), padded[1:half*2+1]))
         def advance(self):
+            keys, head, next_ = self.keys, self.head, self.next_
             if self.pos >= 0x1FFF:
                 prev_pos = self.pos - 0x1FFF
-                dig = self.digraph(prev_pos)
-                self.head[dig] = self.next_[prev_pos % len(self.next_)]
-            dig = self.digraph(self.pos)
-            if self.head[dig] == 0xFFFF:
-                self.head[dig] = self.pos & 0xFFFF
+                head[keys[prev_pos]] = next_[prev_pos & 0x1FFF]
+            dig = keys[self.pos]
+            if head[dig] == 0xFFFF:
+                head[dig] = self.pos & 0xFFFF
             else:
-                self.next_[self.tail[dig]] = self.pos & 0xFFFF
-            self.tail[dig] = (self.pos % len(self.next_)) & 0xFFFF
-            self.next_[self.pos % len(self.next_)] = 0xFFFF
+                next_[self.tail[dig]] = self.pos & 0xFFFF
+            self.tail[dig] = self.pos & 0x1FFF
+            next_[self.pos & 0x1FFF] = 0xFFFF
             self.pos += 1
             return
         def get(self, rep_len, rep_pos):
-            pos = self.head[self.digraph(self.pos)]
+            here = self.pos + 2
+            next_ = self.next_
+            pos = self.head[self.keys[self.pos]]
             while pos != 0xFFFF:
-                len_ = count_equal(self.input_[self.pos+2:], self.input_[pos+2:], 267) + 2
-                if len_ >= rep_len:
-                    rep_len, rep_pos = len_, pos
-                pos = self.next_[pos % len(self.next_)]
+                there = pos + 2
+                known = rep_len - 2 # Bytes a candidate must share to take over from the current best
+                # Reject candidates that fall short, and settle ties on the byte after the current best
+                if known < 1 or view[here:here+known] == view[there:there+known]:
+                    if 0 < known < 267 and here + known < len(input_) and view[here+known] != view[there+known]:
+                        rep_pos = pos
+                    else:
+                        len_ = count_equal(here, there, 267) + 2
+                        if len_ >= rep_len:
+                            rep_len, rep_pos = len_, pos
+                pos = next_[pos & 0x1FFF]
             return(rep_len, rep_pos)
     class Bits:
         def __init__(self, out):
@@ -312,19 +788,111 @@ def compress_mode2(input_):
         def byte(self, v):
             self.out.append(v)
             return
+    # The original encoder: the longest run or match at each position
+    def greedy_parse():
+        input_pos = 0
+        dig = Digraphs(input_)
+        while input_pos < len(input_):
+            # Runs shorter than 14 bytes are not encoded as runs, so only measure the ones that could be
+            if view[input_pos:input_pos+13] == view[input_pos+1:input_pos+14]:
+                run_len = count_equal(input_pos, input_pos+1, 0xFFE) + 1
+            else:
+                run_len = 1
+            if run_len < 14:
+                run_len = 1
+            run_pos = input_pos
+            if (run_len < 64) and (input_pos + 3 < len(input_)):
+                run_len, run_pos = dig.get(run_len, run_pos)
+            assert(run_len > 0)
+            yield(input_pos, run_len, run_pos)
+            for _ in range(run_len):
+                input_pos += 1
+                dig.advance()
+    # Optimal parse for compression_level 2, the mode 2 version of compress_data_block_optimal.  Costs are
+    # in bits: 9 for a literal, 10 (distance under 256) or 15 for a back-reference plus its length code, and
+    # 28 or 36 for a repeated byte.  Matches come from hash chains, walking no more than BZ_MAX_CHAIN
+    # candidates per position.  A candidate starting with the same byte matches as far as the shorter of
+    # the two runs of that byte, so the chains are keyed on the byte pair and the length of the run: only
+    # candidates whose run ends at the same place can match further, and the rest of the run is always
+    # available one byte back.  Yields the same (input_pos, run_len, run_pos) as greedy_parse.
+    def optimal_parse():
+        length = len(input_)
+        short_len, short_dist = array.array('i', [0]) * length, array.array('i', [0]) * length
+        long_len, long_dist = array.array('i', [0]) * length, array.array('i', [0]) * length
+        repeats = array.array('i', [1]) * (length + 1)
+        for i in range(length - 2, -1, -1):
+            if input_[i] == input_[i+1]:
+                repeats[i] = min(repeats[i+1] + 1, BZ_MAX_REPEAT)
+        head = {}
+        head_get = head.get
+        prev = array.array('i', [-1]) * length
+        for i in range(length):
+            limit = min(BZ_MAX_MATCH, length - i)
+            key = (input_[i:i+2], min(repeats[i], BZ_MAX_MATCH))
+            s_len, s_dist, l_len, l_dist = 0, 0, 0, 0
+            if i > 0 and input_[i-1] == input_[i] and repeats[i] >= 2:
+                s_len, s_dist = min(repeats[i], limit), 1
+            if limit >= 2:
+                candidate = head_get(key, -1)
+                chain = BZ_MAX_CHAIN
+                # Candidates come nearest first, so the short distances are all seen before the long ones
+                while candidate >= 0 and i - candidate < 256 and chain > 0 and s_len < limit:
+                    if input_[candidate+s_len] == input_[i+s_len]:
+                        match_len = c77_match_length(input_, candidate, i, limit)
+                        if match_len > s_len:
+                            s_len, s_dist = match_len, i - candidate
+                    candidate = prev[candidate]
+                    chain -= 1
+                l_len = s_len
+                while candidate >= 0 and i - candidate <= BZ_MAX_DISTANCE and chain > 0 and l_len < limit:
+                    if input_[candidate+l_len] == input_[i+l_len]:
+                        match_len = c77_match_length(input_, candidate, i, limit)
+                        if match_len > l_len:
+                            l_len, l_dist = match_len, i - candidate
+                    candidate = prev[candidate]
+                    chain -= 1
+            short_len[i], short_dist[i] = s_len, s_dist
+            if l_len > s_len:
+                long_len[i], long_dist[i] = l_len, l_dist
+            prev[i] = head_get(key, -1)
+            head[key] = i
+        length_code_bits = [0, 0, 1, 2, 3, 4, 8, 8, 8, 8, 8, 8, 8, 8] # Lengths 14 and up take 13 bits
+        cost = [0] * (length + 1)
+        token_len = array.array('i', [1]) * length
+        token_pos = array.array('i', [0]) * length
+        from_14 = SuffixMinima(cost, 14)
+        from_30 = SuffixMinima(cost, 30)
+        for i in range(length - 1, -1, -1):
+            from_14.step(i)
+            from_30.step(i)
+            best, best_len, best_pos = 9 + cost[i+1], 1, i
+            for match_len, distance, flag_bits in [(short_len[i], short_dist[i], 10), (long_len[i], long_dist[i], 15)]:
+                for run_len in range(2, min(13, match_len) + 1):
+                    if flag_bits + length_code_bits[run_len] + cost[i+run_len] < best:
+                        best, best_len, best_pos = flag_bits + length_code_bits[run_len] + cost[i+run_len], run_len, i - distance
+                if match_len >= 14:
+                    value, j = from_14.query(i + match_len)
+                    if flag_bits + 13 + value < best:
+                        best, best_len, best_pos = flag_bits + 13 + value, j - i, i - distance
+            if repeats[i] >= 14:
+                value, j = from_14.query(i + min(29, repeats[i]))
+                if 28 + value < best:
+                    best, best_len, best_pos = 28 + value, j - i, i
+                if repeats[i] >= 30:
+                    value, j = from_30.query(i + repeats[i])
+                    if 36 + value < best:
+                        best, best_len, best_pos = 36 + value, j - i, i
+            cost[i] = best
+            token_len[i] = best_len
+            token_pos[i] = best_pos
+        i = 0
+        while i < length:
+            yield(i, token_len[i], token_pos[i])
+            i += token_len[i]
     # Code start
     assert(len(input_) < 0xFFFF)
-    input_pos = 0
     b = Bits(b'')
-    dig = Digraphs(input_)
-    while input_pos < len(input_):
-        run_len = count_equal(input_[input_pos:], input_[input_pos+1:], 0xFFE) + 1
-        if run_len < 14:
-            run_len = 1
-        run_pos = input_pos
-        if (run_len < 64) and (input_pos + 3 < len(input_)):
-            run_len, run_pos = dig.get(run_len, run_pos)
-        assert(run_len > 0)
+    for input_pos, run_len, run_pos in (optimal_parse() if optimal else greedy_parse()):
         if b.bit(run_len > 1):
             if run_pos == input_pos:
                 b.bit(True)
@@ -357,45 +925,240 @@ def compress_mode2(input_):
                     b.bits(8, m - 14)
         else:
             b.byte(input_[input_pos])
-        for _ in range(run_len):
-            input_pos += 1
-            dig.advance()
     b.bit(True)
     b.bit(True)
     b.bits(13,0)
     return(b.out.tobytes())
 
+# Mode 2 stream made only of literals, for compression_level 0.  The first byte is the method and the
+# second holds 8 literal flags, after that every 16 literal bytes are preceded by an empty u16 of flags.
+# The end marker (flags 1, 1 and 5 zero bits, then a zero byte) goes in the flags left over in the last
+# word, and spills into one more word if it does not fit.
+def store_mode2(input_):
+    out = bytearray(b'\x00\x00') + input_[0:8]
+    free_bits, flag_pos = 8 - min(len(input_), 8), 1
+    for i in range(8, len(input_), 16):
+        flag_pos = len(out)
+        out += b'\x00\x00' + input_[i:i+16]
+        free_bits = 16 - len(input_[i:i+16])
+    used_bits = 16 - free_bits if flag_pos > 1 else 8 - free_bits
+    flags = (0b11 << used_bits) & 0xFFFF
+    out[flag_pos] |= flags & 0xFF
+    if flag_pos > 1:
+        out[flag_pos+1] |= flags >> 8
+    if free_bits < 7:
+        out += struct.pack("<H", 0b11 >> min(free_bits, 2))
+    out.append(0)
+    return(bytes(out))
+
+# Segments that hardly shrink are stored instead of compressed.  Neither C77 nor BZ has an entropy
+# coding stage, only back-references, so a trial run on short windows predicts the result better than
+# byte statistics would.  There is one window for every incompressible_sample_stride bytes (at least
+# two), spread evenly over the segment, so that a segment which is only partly compressible is not
+# stored.  Every window must come out at or above this ratio of its stored size (stored BZ is 18 bytes
+# for every 16), otherwise the whole segment is compressed.
+incompressible_sample_size = 0x800
+incompressible_sample_stride = 0x8000
+incompressible_ratio = 0.97
+
+# Returns None if the segment should be compressed, otherwise an estimate of the seconds saved by not
+# compressing it (the trial time scaled up to the whole segment, less the trial itself).
+def estimate_incompressible (compressor, segment, stored_overhead = 1.0):
+    if len(segment) < incompressible_sample_size * 4:
+        return(None)
+    num_samples = max(2, len(segment) // incompressible_sample_stride)
+    start_time = time.perf_counter()
+    for i in range(num_samples):
+        start = (2 * i + 1) * len(segment) // (2 * num_samples) - incompressible_sample_size // 2
+        sample = segment[start:start+incompressible_sample_size]
+        if len(compressor(sample)) < len(sample) * stored_overhead * incompressible_ratio:
+            return(None)
+    trial_time = time.perf_counter() - start_time
+    return(trial_time * len(segment) / (incompressible_sample_size * num_samples) - trial_time)
+
+# These return (data, is_stored, seconds_saved, greedy_size) and run in the worker processes of
+# compress_segments, so the compression level is passed in rather than read from the global.  At level 2
+# the greedy output is made as well, to measure the gain, and kept if it is somehow not larger.
+def compress_or_store_c77 (segment, level = 1):
+    seconds_saved = estimate_incompressible(compress_data_block, segment)
+    if seconds_saved is not None:
+        return(segment, True, seconds_saved, len(segment))
+    greedy = compress_data_block(segment)
+    if level >= 2:
+        return(min([compress_data_block_optimal(segment), greedy], key = len), False, 0.0, len(greedy))
+    else:
+        return(greedy, False, 0.0, len(greedy))
+
+def compress_or_store_mode2 (chunk, level = 1):
+    seconds_saved = estimate_incompressible(compress_mode2, chunk, 18 / 16)
+    if seconds_saved is not None:
+        stored = store_mode2(chunk)
+        return(stored, True, seconds_saved, len(stored))
+    greedy = compress_mode2(chunk)
+    if level >= 2:
+        return(min([compress_mode2(chunk, optimal = True), greedy], key = len), False, 0.0, len(greedy))
+    else:
+        return(greedy, False, 0.0, len(greedy))
+
+def report_stored_segments (results, segments, kind):
+    stored = [i for i in range(len(results)) if results[i][1]]
+    if len(stored) > 0:
+        print("Stored {0} of {1} data {2} without compression ({3} bytes, estimated {4:.2f}s saved)".format(len(stored),\
+            len(results), kind, sum([len(segments[i]) for i in stored]), sum([results[i][2] for i in stored])))
+    return
+
+def count_ratio_gain (results):
+    global max_ratio_greedy_bytes, max_ratio_bytes
+    if compression_level >= 2:
+        max_ratio_greedy_bytes += sum([x[3] for x in results])
+        max_ratio_bytes += sum([len(x[0]) for x in results])
+    return
+
+# Returns (greedy bytes, compressed bytes) of everything compressed at level 2 since the last call
+def take_ratio_report ():
+    global max_ratio_greedy_bytes, max_ratio_bytes
+    report = (max_ratio_greedy_bytes, max_ratio_bytes)
+    max_ratio_greedy_bytes, max_ratio_bytes = 0, 0
+    return(report)
+
+def set_block_cache (folder, max_size = 256 * 1024 * 1024):
+    global block_cache_folder, block_cache_max_size, block_cache_size
+    block_cache_folder, block_cache_max_size, block_cache_size = folder, max_size, None
+    return
+
+# Deletes the least recently used entries (every hit touches its file) until the cache fits max_size
+def trim_block_cache ():
+    global block_cache_size
+    entries = sorted([x for x in os.scandir(block_cache_folder) if x.name.endswith('.bin')],\
+        key = lambda x: x.stat().st_mtime)
+    block_cache_size = sum([x.stat().st_size for x in entries])
+    for entry in entries:
+        if block_cache_size <= block_cache_max_size:
+            break
+        try:
+            entry_size = entry.stat().st_size
+            os.remove(entry.path)
+            block_cache_size -= entry_size
+        except OSError:
+            pass
+    return
+
+# Cache entries hold is_stored and greedy_size of compress_or_store_*, followed by the compressed data
+def read_cached_segment (key):
+    path = os.path.join(block_cache_folder, key + '.bin')
+    try:
+        with open(path, 'rb') as f:
+            is_stored, greedy_size = struct.unpack("<2I", f.read(8))
+            data = f.read()
+        os.utime(path)
+    except (OSError, struct.error):
+        return(None)
+    return((data, bool(is_stored), 0.0, greedy_size))
+
+def write_cached_segment (key, result):
+    global block_cache_size
+    path = os.path.join(block_cache_folder, key + '.bin')
+    try:
+        if block_cache_size is None:
+            os.makedirs(block_cache_folder, exist_ok = True)
+            trim_block_cache()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(struct.pack("<2I", result[1], result[3]) + result[0])
+        os.replace(path + '.tmp', path)
+        block_cache_size += len(result[0]) + 8
+        if block_cache_size > block_cache_max_size:
+            trim_block_cache()
+    except OSError:
+        pass
+    return
+
+# compress_segments with a compress_or_store_* function, looking every segment up in the block cache first.
+# The key covers the segment, the format (kind), the compression level and COMPRESSOR_VERSION.
+def cached_compress_segments (compressor, kind, segments):
+    if block_cache_folder is None:
+        return(compress_segments(partial(compressor, level = compression_level), segments))
+    keys = [hashlib.sha256("{0} {1} {2} ".format(kind, compression_level, COMPRESSOR_VERSION).encode()\
+        + bytes(x)).hexdigest() for x in segments]
+    results = [read_cached_segment(x) for x in keys]
+    missing = [i for i in range(len(segments)) if results[i] is None]
+    if len(missing) < len(segments):
+        print("Reusing {0} of {1} compressed segments from the cache".format(len(segments) - len(missing), len(segments)))
+    compressed = compress_segments(partial(compressor, level = compression_level), [segments[i] for i in missing])
+    for i in range(len(missing)):
+        results[missing[i]] = compressed[i]
+        if not compressed[i][1]: # Stored segments are quicker to check again than to read back
+            write_cached_segment(keys[missing[i]], compressed[i])
+    return(results)
+
+def set_compression_level (level):
+    global compression_level
+    compression_level = level
+    return
+
+# Segments are compressed independently of each other, so they can be handed out to a process pool.
+# Results come back in the same order as the segments.
+def set_compression_workers (workers):
+    global compression_workers, compression_pool
+    if compression_pool is not None:
+        compression_pool.shutdown()
+        compression_pool = None
+    compression_workers = max(1, workers if workers > 0 else (os.cpu_count() or 1))
+    return
+
+def compress_segments (compressor, segments):
+    global compression_pool
+    if compression_workers > 1 and len(segments) > 1:
+        if compression_pool is None:
+            compression_pool = ProcessPoolExecutor(max_workers = compression_workers)
+        return(list(compression_pool.map(compressor, segments)))
+    else:
+        return([compressor(x) for x in segments])
+
 def compress_data_mode2(data):
     def chunk_bytes(data, chunk_size):
         if len(data) > 0:
             return([data[i*chunk_size : (i+1)*chunk_size] for i in range((len(data) - 1) // chunk_size + 1)])
         else:
             return([])
-    def compressed_chunk(chunk_data):
-        cchunk = compress_mode2(chunk_data)
+    def compressed_chunk(cchunk):
         return(struct.pack("<H", len(cchunk) + 2) + cchunk)
     chunk_data = chunk_bytes(data, 0x7FF0)
-    cdata = bytes()
-    for i in range(len(chunk_data)):
-        print("Compressing data chunk {0} of {1}.".format(i+1, len(chunk_data)))
-        cdata += compressed_chunk(chunk_data[i]) + b'\x01'
-    cdata += compressed_chunk(chunk_data[-1][0].to_bytes()) if len(chunk_data) > 0 else compressed_chunk(b'') + b'\x00'
+    if compression_level == 0:
+        compressor = store_mode2
+        results = [(compressor(x), True, 0.0, len(x)) for x in chunk_data]
+    else:
+        compressor = compress_mode2
+        print("Compressing {0} data chunks...".format(len(chunk_data)))
+        results = cached_compress_segments(compress_or_store_mode2, 'bz', chunk_data)
+        report_stored_segments(results, chunk_data, 'chunks')
+        count_ratio_gain(results)
+    cdata = b''.join([compressed_chunk(x[0]) + b'\x01' for x in results])
+    cdata += compressed_chunk(compressor(chunk_data[-1][0].to_bytes())) if len(chunk_data) > 0\
+        else compressed_chunk(compressor(b'')) + b'\x00'
     return(struct.pack("<3I", len(cdata) + 8, len(data), len(chunk_data) + 1) + cdata)
 
 # Content should be a bytes-like object.
 def create_data_blocks (content, mode = 3):
     if mode == 3:
         segment_size = 0x40000 # Separate into chunks of this size prior to compression
-        uncompressed_sizes = [len(content[i:i+segment_size]) for i in range(0, max(1,len(content)), segment_size)]
-        print("Compressing {0} data blocks...".format(len(uncompressed_sizes)))
-        compressed_content = [compress_data_block(content[i:i+segment_size]) for i in range(0, max(1,len(content)), segment_size)]
+        segments = [content[i:i+segment_size] for i in range(0, max(1,len(content)), segment_size)]
+        uncompressed_sizes = [len(x) for x in segments]
+        if compression_level == 0:
+            results = [(x, True, 0.0, len(x)) for x in segments]
+        else:
+            print("Compressing {0} data blocks...".format(len(uncompressed_sizes)))
+            results = cached_compress_segments(compress_or_store_c77, 'c77', segments)
+            report_stored_segments(results, segments, 'blocks')
+            count_ratio_gain(results)
+        compressed_content = [x[0] for x in results]
+        block_types = [0 if x[1] else 8 for x in results] # Anything other than 8 is read back as is
         compressed_sizes = [len(x) for x in compressed_content]
         compressed_block = struct.pack("<5I", 0x80000001, len(uncompressed_sizes), sum([x+12 for x in compressed_sizes]),\
             max([x+12 for x in compressed_sizes]), len(content)) +\
-            b''.join([(struct.pack("<3I", compressed_sizes[i]+4, uncompressed_sizes[i], 8) + compressed_content[i]) for i in range(len(uncompressed_sizes))])
+            b''.join([(struct.pack("<3I", compressed_sizes[i]+4, uncompressed_sizes[i], block_types[i]) + compressed_content[i]) for i in range(len(uncompressed_sizes))])
         return(compressed_block)
     elif mode == 2:
         return(compress_data_mode2(content))
     else:
         print("Only C77 (mode 3) and mode 2 variant of bz currently supported.")
-        raise
\ No newline at end of file
+        raise
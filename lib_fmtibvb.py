@@ -1,13 +1,17 @@
 # A small library of functions to read and write .fmt / .ib / .vb files into and out of
-# python structures that are JSON serializable.
+# python structures that are JSON serializable.  Vertex buffers can also be read as numpy arrays,
+# one per element, by passing as_arrays = True, and MeshBuffer keeps a whole mesh that way.
 #
 # GitHub eArmada8/gust_stuff
 
-import io, re, struct, json
+import io, re, struct, json, mmap, os, hashlib, numpy
+from functools import lru_cache
 
-# Currently only simple formats (8-, 16-, and 32-bit) are supported.  Floats must be 32-bit.
-# Attempting to read an unsupported format will return a raw bytes object.
-def unpack_dxgi_vector(f, stride, dxgi_format, e = '<'):
+# Splits a DXGI format into its number type, bits per component and number of components,
+# e.g. DXGI_FORMAT_R32G32B32_FLOAT into ('FLOAT', 32, 3).  Results are cached since the same
+# handful of formats is parsed for every vertex.
+@lru_cache(maxsize=None)
+def parse_dxgi_format(dxgi_format):
     dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
     dxgi_format_split = dxgi_format.split('_')
     if len(dxgi_format_split) == 2:
@@ -20,7 +24,13 @@ def unpack_dxgi_vector(f, stride, dxgi_format, e = '<'):
             vec_bits = 0
             vec_elements = 0
     else:
-        numtype = 'UNSUPPORTED'
+        numtype, vec_bits, vec_elements = 'UNSUPPORTED', 0, 0
+    return(numtype, vec_bits, vec_elements)
+
+# Currently only simple formats (8-, 16-, and 32-bit) are supported.  Floats must be 32-bit.
+# Attempting to read an unsupported format will return a raw bytes object.
+def unpack_dxgi_vector(f, stride, dxgi_format, e = '<'):
+    numtype, vec_bits, vec_elements = parse_dxgi_format(dxgi_format)
 
     if numtype == 'FLOAT' and (vec_elements * vec_bits / 8 == stride):
         if vec_bits == 32:
@@ -70,19 +80,7 @@ def unpack_dxgi_vector(f, stride, dxgi_format, e = '<'):
     return (read)
 
 def pack_dxgi_vector(f, data, stride, dxgi_format, e = '<'):
-    dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
-    dxgi_format_split = dxgi_format.split('_')
-    if len(dxgi_format_split) == 2:
-        numtype = dxgi_format_split[1]
-        vec_format = re.findall("[0-9]+",dxgi_format_split[0])
-        if len(vec_format) > 0:
-            vec_bits = int(vec_format[0])
-            vec_elements = len(vec_format)
-        else:
-            vec_bits = 0
-            vec_elements = 0
-    else:
-        numtype = 'UNSUPPORTED'
+    numtype, vec_bits, vec_elements = parse_dxgi_format(dxgi_format)
 
     if numtype == 'FLOAT' and (vec_elements * vec_bits / 8 == stride):
         for i in range(vec_elements):
@@ -147,6 +145,122 @@ def get_stride_from_dxgi_format(dxgi_format):
     else:
         return False
 
+# numpy type of one component, or None if the format is not one unpack_dxgi_vector can decode
+def get_numpy_component_type(numtype, vec_bits, e = '<'):
+    component_types = {'FLOAT': {32: 'f4', 16: 'f2'}, 'UINT': {32: 'u4', 16: 'u2', 8: 'u1'},\
+        'SINT': {32: 'i4', 16: 'i2', 8: 'i1'}, 'UNORM': {32: 'u4', 16: 'u2', 8: 'u1'},\
+        'SNORM': {32: 'i4', 16: 'i2', 8: 'i1'}}
+    if numtype in component_types and vec_bits in component_types[numtype]:
+        return(e + component_types[numtype][vec_bits])
+    else:
+        return None
+
+vb_dtype_cache = {}
+
+# Compiles the elements of a fmt (or of one input slot of a segmented fmt) into a numpy structured
+# dtype with one field per element, named by its position in the element list.  Elements that
+# unpack_dxgi_vector would return as raw bytes (unsupported formats, or padding after the element)
+# become void fields of the whole distance to the next element, the same as unpack_dxgi_vector.
+def get_vb_dtype(fmt_struct, input_slot = None, e = '<'):
+    if input_slot == None:
+        stride = int(fmt_struct["stride"])
+        elements = fmt_struct["elements"]
+    else:
+        stride = int(fmt_struct["vb{} stride".format(input_slot)])
+        elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
+    key = (stride, e, tuple([(x["Format"], x["AlignedByteOffset"]) for x in elements]))
+    if not key in vb_dtype_cache:
+        offsets = [int(x["AlignedByteOffset"]) for x in elements]
+        buffer_strides = [end - start for (start, end) in zip(offsets, offsets[1:] + [stride])]
+        formats = []
+        for i in range(len(elements)):
+            numtype, vec_bits, vec_elements = parse_dxgi_format(elements[i]["Format"])
+            component_type = get_numpy_component_type(numtype, vec_bits, e)
+            if component_type != None and (vec_elements * vec_bits / 8 == buffer_strides[i]):
+                formats.append((component_type, (vec_elements,)))
+            else:
+                formats.append('V{}'.format(buffer_strides[i]))
+        vb_dtype_cache[key] = numpy.dtype({'names': [str(i) for i in range(len(elements))],\
+            'formats': formats, 'offsets': offsets, 'itemsize': stride})
+    return(vb_dtype_cache[key])
+
+# Decodes a whole vertex buffer at once.  Returns the elements as a list of (fmt element, buffer), where
+# buffer is a numpy array of shape (num_vertex, components) with UNORM / SNORM already normalized to
+# floats, or an array of raw bytes (numpy void) for unsupported formats.
+def decode_vb_elements(vb_stream, fmt_struct, input_slot = None, e = '<'):
+    if input_slot == None:
+        elements = fmt_struct["elements"]
+    else:
+        elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
+    vb_dtype = get_vb_dtype(fmt_struct, input_slot, e)
+    num_vertex = int(len(vb_stream) / vb_dtype.itemsize)
+    vertices = numpy.frombuffer(vb_stream, dtype = vb_dtype, count = num_vertex)
+    decoded = []
+    for i in range(len(elements)):
+        element_buffer = vertices[str(i)]
+        if element_buffer.dtype.kind != 'V':
+            numtype, vec_bits, vec_elements = parse_dxgi_format(elements[i]["Format"])
+            # Convert to normalized floats
+            if numtype == 'UNORM':
+                element_buffer = element_buffer / float((2**vec_bits)-1)
+            elif numtype == 'SNORM':
+                element_buffer = element_buffer / float((2**(vec_bits-1))-1)
+        decoded.append((elements[i], element_buffer))
+    return(decoded)
+
+# Converts the buffer of one element (a list of lists, or an array) to the type of its dtype field, clamping
+# and rounding UNORM / SNORM the same way pack_dxgi_vector does.  Extra components are dropped, also the
+# same as pack_dxgi_vector, e.g. when 4D positions are written to a R32G32B32_FLOAT element.  Values that do
+# not fit the format raise the same errors as struct.pack in pack_dxgi_vector, instead of wrapping around.
+def encode_vb_element(element_buffer, field_type, dxgi_format, num_vertex):
+    if field_type.subdtype == None: # Raw bytes
+        return(numpy.array(element_buffer, dtype = field_type).reshape(num_vertex))
+    numtype, vec_bits, vec_elements = parse_dxgi_format(dxgi_format)
+    try:
+        values = numpy.asarray(element_buffer)
+    except ValueError: # Vectors of different lengths
+        values = None
+    if values is None or values.ndim != 2:
+        values = numpy.array([x[0:vec_elements] for x in element_buffer]).reshape(num_vertex, vec_elements)
+    values = values[:,0:vec_elements]
+    if numtype == 'UNORM':
+        values = numpy.round(numpy.clip(values, 0, 1) * ((2**vec_bits)-1))
+    elif numtype == 'SNORM':
+        values = numpy.round(numpy.clip(values, -1, 1) * ((2**(vec_bits-1))-1))
+    elif numtype in ['UINT', 'SINT'] and values.size > 0:
+        limits = numpy.iinfo(field_type.base)
+        if values.min() < limits.min or values.max() > limits.max:
+            raise struct.error("{0} values must be between {1} and {2}, found values from {3} to {4}".format(\
+                dxgi_format, limits.min, limits.max, values.min(), values.max()))
+    elif numtype == 'FLOAT':
+        with numpy.errstate(over = 'ignore'):
+            converted = values.astype(field_type.base)
+        if numpy.any(numpy.isinf(converted) & numpy.isfinite(values)):
+            raise OverflowError("{0} values too large to pack, found values up to {1}".format(\
+                dxgi_format, numpy.abs(values[numpy.isfinite(values)]).max()))
+        return(converted)
+    return(values.astype(field_type.base))
+
+# Builds the byte image of a whole vertex buffer (or of one input slot of a segmented fmt) in one pass.
+# With interleave = False, each element is written out for every vertex before moving to the next element.
+def encode_vb_elements(vb_data, fmt_struct, input_slot = None, e = '<', interleave = True):
+    if input_slot == None:
+        elements = fmt_struct["elements"]
+    else:
+        elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
+        vb_data = [x for x in vb_data if x['InputSlot'] == input_slot]
+    vb_dtype = get_vb_dtype(fmt_struct, input_slot, e)
+    num_vertex = len(vb_data[0]["Buffer"])
+    columns = [encode_vb_element(vb_data[i]["Buffer"], vb_dtype.fields[str(i)][0], elements[i]["Format"], num_vertex)\
+        for i in range(len(elements))]
+    if interleave == True:
+        vertices = numpy.zeros(num_vertex, dtype = vb_dtype)
+        for i in range(len(elements)):
+            vertices[str(i)] = columns[i]
+        return(vertices.tobytes())
+    else:
+        return(b''.join([x.tobytes() for x in columns]))
+
 def read_fmt(fmt_filename):
     fmt_struct = {}
     with open(fmt_filename, 'r') as f:
@@ -188,115 +302,103 @@ def write_fmt(fmt_struct, fmt_filename):
         f.write(output)
     return
 
-def read_ib_stream(ib_stream, fmt_struct, e = '<'):
-    ib_data = []
-    # Cheating a bit here, since all index buffers I've seen are single numbers, but fmt doesn't have a stride for IB
-    ib_stride = int(int(re.findall("[0-9]+", fmt_struct["format"])[0])/8)
-    with io.BytesIO(ib_stream) as f:
-        length = f.seek(0,2)
-        f.seek(0)
-        vertex_num = 0
-        triangle = []
-        while f.tell() < length:
-            triangle.extend(unpack_dxgi_vector(f, ib_stride, fmt_struct["format"], e))
-            vertex_num += 1
-            if vertex_num % 3 == 0 or f.tell() == length:
-                ib_data.append(triangle)
-                triangle = []
-    return(ib_data)
-
-def read_ib(ib_filename, fmt_struct, e = '<'):
-    with open(ib_filename, 'rb') as f:
-        ib_stream = f.read()
-    return(read_ib_stream(ib_stream, fmt_struct, e))
-
-def write_ib_stream(ib_data, ib_stream, fmt_struct, e = '<'):
-    # See above about cheating
-    ib_stride = int(int(re.findall("[0-9]+", fmt_struct["format"])[0])/8)
-    if len(ib_data) > 0:
-        if type(ib_data[0]) == list: # Flatten list for legacy code
-            new_ib_data = [x for y in ib_data for x in y]
+# With use_mmap = True, the file is memory mapped read-only instead of read, so the arrays read from it
+# (as_arrays = True) are views of the file and nothing is loaded until it is used.  Empty files cannot be
+# mapped, and give empty bytes.
+def read_buffer_file(filename, use_mmap = False):
+    with open(filename, 'rb') as f:
+        if use_mmap == False:
+            return(f.read())
+        elif os.fstat(f.fileno()).st_size == 0:
+            return(b'')
         else:
-            new_ib_data = ib_data
+            return(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
+# numpy type of the indices.  All index buffers I've seen are single numbers (R16_UINT or R32_UINT), but fmt
+# doesn't have a stride for IB, so it comes from the format.
+def get_ib_dtype(fmt_struct, e = '<'):
+    numtype, vec_bits, vec_elements = parse_dxgi_format(fmt_struct["format"])
+    return(numpy.dtype(get_numpy_component_type(numtype, vec_bits, e)))
+
+# Swaps triangles between D3D and OpenGL order by exchanging the last two columns.  Takes the (N,3) arrays
+# from read_ib_stream(..., as_arrays = True) as well as lists of triangles.  Arrays are copied, unless
+# in_place is set and the array is writeable (i.e. not a view of a file or of bytes), in which case the
+# columns are exchanged within the array and only one column is copied.
+def swap_winding_order(ib_data, in_place = False):
+    if isinstance(ib_data, numpy.ndarray):
+        if in_place == True and ib_data.flags.writeable:
+            ib_data[:,1], ib_data[:,2] = ib_data[:,2], ib_data[:,1].copy()
+            return(ib_data)
+        return(ib_data[:,(0,2,1)])
     else:
-        new_ib_data = ib_data
-    for i in range(len(new_ib_data)):
-        pack_dxgi_vector(ib_stream, [new_ib_data[i]], ib_stride, fmt_struct["format"], e)
+        return([[x[0],x[2],x[1]] for x in ib_data])
+
+# With as_arrays = True, returns an (N,3) array of triangles (a view of ib_stream unless swap_winding
+# is set).  Indices after the last complete triangle are only kept in the list version.
+def read_ib_stream(ib_stream, fmt_struct, e = '<', as_arrays = False, swap_winding = False):
+    ib_dtype = get_ib_dtype(fmt_struct, e)
+    indices = numpy.frombuffer(ib_stream, dtype = ib_dtype, count = len(ib_stream) // ib_dtype.itemsize)
+    triangles = indices[0:len(indices) // 3 * 3].reshape(-1, 3)
+    if swap_winding == True:
+        triangles = swap_winding_order(triangles)
+    if as_arrays == True:
+        return(triangles)
+    ib_data = triangles.tolist()
+    if len(indices) % 3 > 0:
+        ib_data.append(indices[len(indices) // 3 * 3:].tolist())
+    return(ib_data)
+
+def read_ib(ib_filename, fmt_struct, e = '<', as_arrays = False, swap_winding = False, use_mmap = False):
+    ib_stream = read_buffer_file(ib_filename, use_mmap)
+    return(read_ib_stream(ib_stream, fmt_struct, e, as_arrays, swap_winding))
+
+# Accepts a list of triangles, a flat list of indices or an (N,3) array
+def write_ib_stream(ib_data, ib_stream, fmt_struct, e = '<', swap_winding = False):
+    if swap_winding == True:
+        ib_data = swap_winding_order(ib_data)
+    try:
+        indices = numpy.asarray(ib_data)
+    except ValueError: # Incomplete last triangle
+        indices = numpy.array([x for y in ib_data for x in y])
+    ib_stream.write(indices.astype(get_ib_dtype(fmt_struct, e), copy = False).tobytes())
     return
 
-def write_ib(ib_data, ib_filename, fmt_struct, e = '<'):
+def write_ib(ib_data, ib_filename, fmt_struct, e = '<', swap_winding = False):
     with open(ib_filename, 'wb') as f:
-        write_ib_stream(ib_data, f, fmt_struct, e)
+        write_ib_stream(ib_data, f, fmt_struct, e, swap_winding)
     return
 
-def read_vb_stream(vb_stream, fmt_struct, e = '<'):
+# With as_arrays = True, each Buffer is the numpy array from decode_vb_elements instead of a list of lists
+def read_vb_stream(vb_stream, fmt_struct, e = '<', as_arrays = False):
     vb_data = []
-    with io.BytesIO(vb_stream) as f:
-        length = f.seek(0,2)
-        f.seek(0)
-        num_vertex = int(length / int(fmt_struct["stride"]))
-        buffer_strides = []
-        # Calculate individual buffer strides
-        for i in range(len(fmt_struct["elements"])):
-            if i == len(fmt_struct["elements"]) - 1:
-                buffer_strides.append(int(fmt_struct["stride"]) - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
-            else:
-                buffer_strides.append(int(fmt_struct["elements"][i+1]["AlignedByteOffset"]) \
-                    - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
-        # Read in the buffers
-        for i in range(len(fmt_struct["elements"])):
-            element = {}
-            element["SemanticName"] = fmt_struct["elements"][i]["SemanticName"]
-            element["SemanticIndex"] = fmt_struct["elements"][i]["SemanticIndex"]
-            element_buffer = []
-            for j in range(num_vertex):
-                f.seek(j * int(fmt_struct["stride"]) + int(fmt_struct["elements"][i]["AlignedByteOffset"]),0)
-                element_buffer.append(unpack_dxgi_vector(f, buffer_strides[i], fmt_struct["elements"][i]["Format"], e))
-            element["Buffer"] = element_buffer
-            vb_data.append(element)
+    for fmt_element, element_buffer in decode_vb_elements(vb_stream, fmt_struct, e = e):
+        element = {}
+        element["SemanticName"] = fmt_element["SemanticName"]
+        element["SemanticIndex"] = fmt_element["SemanticIndex"]
+        element["Buffer"] = element_buffer if as_arrays else element_buffer.tolist()
+        vb_data.append(element)
     return(vb_data)
 
-def read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e = '<'):
-    seg_stride = "vb{} stride".format(input_slot)
-    seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
+def read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e = '<', as_arrays = False):
     vb_data = []
-    with io.BytesIO(vb_stream) as f:
-        length = f.seek(0,2)
-        f.seek(0)
-        num_vertex = int(length / int(fmt_struct[seg_stride]))
-        buffer_strides = []
-        # Calculate individual buffer strides
-        for i in range(len(seg_elements)):
-            if i == len(seg_elements) - 1:
-                buffer_strides.append(int(fmt_struct[seg_stride]) - int(seg_elements[i]["AlignedByteOffset"]))
-            else:
-                buffer_strides.append(int(seg_elements[i+1]["AlignedByteOffset"]) \
-                    - int(seg_elements[i]["AlignedByteOffset"]))
-        # Read in the buffers
-        for i in range(len(seg_elements)):
-            element = {}
-            element["SemanticName"] = seg_elements[i]["SemanticName"]
-            element["SemanticIndex"] = seg_elements[i]["SemanticIndex"]
-            element["InputSlot"] = seg_elements[i]["InputSlot"]
-            element_buffer = []
-            for j in range(num_vertex):
-                f.seek(j * int(fmt_struct[seg_stride]) + int(seg_elements[i]["AlignedByteOffset"]),0)
-                element_buffer.append(unpack_dxgi_vector(f, buffer_strides[i], seg_elements[i]["Format"], e))
-            element["Buffer"] = element_buffer
-            vb_data.append(element)
+    for fmt_element, element_buffer in decode_vb_elements(vb_stream, fmt_struct, input_slot, e):
+        element = {}
+        element["SemanticName"] = fmt_element["SemanticName"]
+        element["SemanticIndex"] = fmt_element["SemanticIndex"]
+        element["InputSlot"] = fmt_element["InputSlot"]
+        element["Buffer"] = element_buffer if as_arrays else element_buffer.tolist()
+        vb_data.append(element)
     return(vb_data)
 
-def read_vb(vb_filename, fmt_struct, e = '<'):
+def read_vb(vb_filename, fmt_struct, e = '<', as_arrays = False, use_mmap = False):
     if 'stride' in fmt_struct:
-        with open(vb_filename, 'rb') as f:
-            vb_stream = f.read()
-        return(read_vb_stream(vb_stream, fmt_struct, e))
+        vb_stream = read_buffer_file(vb_filename, use_mmap)
+        return(read_vb_stream(vb_stream, fmt_struct, e, as_arrays))
     elif 'vb0 stride' in fmt_struct:
         vb = []
         for input_slot in [x[2:-7] for x in fmt_struct if len(x.split('stride')) > 1]:
-            with open(vb_filename + input_slot, 'rb') as f:
-                vb_stream = f.read()
-            vb.extend(read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e))
+            vb_stream = read_buffer_file(vb_filename + input_slot, use_mmap)
+            vb.extend(read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e, as_arrays))
         return(vb)
     else:
         print("Decoding error when trying to interpret fmt file for {0}!\r\n".format(vb_filename))
@@ -304,48 +406,11 @@ def read_vb(vb_filename, fmt_struct, e = '<'):
         raise
 
 def write_vb_stream(vb_data, vb_stream, fmt_struct, e = '<', interleave = True):
-    buffer_strides = []
-    # Calculate individual buffer strides
-    for i in range(len(fmt_struct["elements"])):
-        if i == len(fmt_struct["elements"]) - 1:
-            buffer_strides.append(int(fmt_struct["stride"]) - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
-        else:
-            buffer_strides.append(int(fmt_struct["elements"][i+1]["AlignedByteOffset"]) \
-                - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
-    if interleave == True:
-        # Write out the buffers, vertex by vertex.
-        for j in range(len(vb_data[0]["Buffer"])):
-            for i in range(len(fmt_struct["elements"])):
-                pack_dxgi_vector(vb_stream, vb_data[i]["Buffer"][j], buffer_strides[i], fmt_struct["elements"][i]["Format"], e)
-    else:
-        # Write out the buffers, element by element.
-        for i in range(len(fmt_struct["elements"])):
-            for j in range(len(vb_data[0]["Buffer"])):
-                pack_dxgi_vector(vb_stream, vb_data[i]["Buffer"][j], buffer_strides[i], fmt_struct["elements"][i]["Format"], e)
+    vb_stream.write(encode_vb_elements(vb_data, fmt_struct, e = e, interleave = interleave))
     return
 
 def write_seg_vb_stream(vb_data, vb_stream, fmt_struct, input_slot, e = '<', interleave = True):
-    buffer_strides = []
-    seg_stride = fmt_struct["vb{} stride".format(input_slot)]
-    seg_vb_data = [x for x in vb_data if x['InputSlot'] == input_slot]
-    seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
-    # Calculate individual buffer strides
-    for i in range(len(seg_elements)):
-        if i == len(seg_elements) - 1:
-            buffer_strides.append(int(seg_stride) - int(seg_elements[i]["AlignedByteOffset"]))
-        else:
-            buffer_strides.append(int(seg_elements[i+1]["AlignedByteOffset"]) \
-                - int(seg_elements[i]["AlignedByteOffset"]))
-    if interleave == True:
-        # Write out the buffers, vertex by vertex.
-        for j in range(len(seg_vb_data[0]["Buffer"])):
-            for i in range(len(seg_elements)):
-                pack_dxgi_vector(vb_stream, seg_vb_data[i]["Buffer"][j], buffer_strides[i], seg_elements[i]["Format"], e)
-    else:
-        # Write out the buffers, element by element.
-        for i in range(len(seg_elements)):
-            for j in range(len(seg_vb_data[0]["Buffer"])):
-                pack_dxgi_vector(vb_stream, seg_vb_data[i]["Buffer"][j], buffer_strides[i], seg_elements[i]["Format"], e)
+    vb_stream.write(encode_vb_elements(vb_data, fmt_struct, input_slot, e = e, interleave = interleave))
     return
 
 def write_vb(vb_data, vb_filename, fmt_struct, e = '<', interleave = True):
@@ -362,6 +427,199 @@ def write_vb(vb_data, vb_filename, fmt_struct, e = '<', interleave = True):
         raise
     return
 
+# Converts a legacy Buffer list to a numpy array.  Raw bytes become numpy void so that trailing zero bytes
+# are kept, and lists numpy cannot make into a regular array (vectors of different lengths) are kept as lists.
+def legacy_to_array(values):
+    if len(values) > 0 and isinstance(values[0], bytes):
+        return(numpy.array(values, dtype = 'V{}'.format(len(values[0]))))
+    try:
+        return(numpy.asarray(values))
+    except ValueError:
+        return(values)
+
+def array_to_legacy(values):
+    if isinstance(values, numpy.ndarray):
+        return(values.tolist())
+    else:
+        return(values)
+
+# A mesh stored as one numpy array per vertex buffer element instead of lists of small lists.  The attributes
+# hold the arrays: fmt, ib (the (N,3) triangles from read_ib_stream(..., as_arrays = True)) and vb (the elements
+# from read_vb_stream(..., as_arrays = True), dicts with SemanticName, SemanticIndex and a numpy Buffer).
+#
+# Indexing it like a dictionary gives the legacy mesh dict shape instead, so that code written for
+# {'fmt':..., 'ib':..., 'vb':...} can take a MeshBuffer and be moved over to the arrays later.  mesh['ib'] and
+# mesh['vb'] are converted to lists the first time they are used (and again if the attribute is replaced).
+# Changes made inside those lists are not seen by the arrays, so assign them back (mesh['vb'] = vb) instead.
+# Any other key (material, fmt_bitmask, ...) is kept as is.
+#
+# A mesh read straight out of a game file can be given as raw_vb instead of vb: the vertex bytes, already laid
+# out as fmt describes (single input slot, little endian).  vb is then decoded from raw_vb the first time it
+# is used.  Until that happens, write_mesh_buffer() writes raw_vb to the .vb file unchanged, and get_buffer()
+# reads integer and float elements through a strided view of raw_vb without decoding anything.
+class MeshBuffer:
+    __slots__ = ('fmt', 'ib', 'decoded_vb', 'raw_vb', 'extra', 'legacy')
+
+    def __init__ (self, fmt, ib, vb = None, raw_vb = None, **extra):
+        self.fmt = fmt
+        self.ib = ib
+        self.decoded_vb = vb
+        if vb is None and raw_vb is not None:
+            stride = int(fmt['stride'])
+            self.raw_vb = memoryview(raw_vb)[0:len(raw_vb) // stride * stride] # Whole vertices only, as decoded
+        else:
+            self.raw_vb = None
+        self.extra = extra
+        self.legacy = {}
+
+    @property
+    def vb (self):
+        if self.decoded_vb is None:
+            self.decoded_vb = read_vb_stream(self.raw_vb, self.fmt, as_arrays = True)
+        return(self.decoded_vb)
+
+    @vb.setter
+    def vb (self, value):
+        self.decoded_vb = value
+        self.raw_vb = None
+
+    def __getitem__ (self, key):
+        if key == 'fmt':
+            return(self.fmt)
+        elif key in ['ib', 'vb']:
+            source = getattr(self, key)
+            if not (key in self.legacy and self.legacy[key][0] is source):
+                if key == 'ib':
+                    self.legacy[key] = (source, array_to_legacy(source))
+                else:
+                    self.legacy[key] = (source, [dict(x, Buffer = array_to_legacy(x['Buffer'])) for x in source])
+            return(self.legacy[key][1])
+        else:
+            return(self.extra[key])
+
+    def __setitem__ (self, key, value):
+        if key == 'fmt':
+            self.fmt = value
+        elif key == 'ib':
+            self.ib = legacy_to_array(value)
+        elif key == 'vb':
+            self.vb = [dict(x, Buffer = legacy_to_array(x['Buffer'])) for x in value]
+        else:
+            self.extra[key] = value
+
+    def __contains__ (self, key):
+        return(key in ['fmt', 'ib', 'vb'] or key in self.extra)
+
+    def to_dict (self):
+        return({'fmt': self['fmt'], 'ib': self['ib'], 'vb': self['vb'], **self.extra})
+
+    # True while the vertex buffer is still the untouched raw_vb
+    def is_raw (self):
+        return(self.decoded_vb is None and self.raw_vb is not None)
+
+    def num_vertices (self):
+        if self.is_raw():
+            return(len(self.raw_vb) // int(self.fmt['stride']))
+        return(len(self.vb[0]['Buffer']) if len(self.vb) > 0 else 0)
+
+    def get_buffer (self, semantic_name, semantic_index = '0'):
+        if self.is_raw():
+            i = [i for i in range(len(self.fmt['elements'])) if self.fmt['elements'][i]['SemanticName'] == semantic_name\
+                and self.fmt['elements'][i]['SemanticIndex'] == semantic_index][0]
+            if not parse_dxgi_format(self.fmt['elements'][i]['Format'])[0] in ['UNORM', 'SNORM']: # No conversion needed
+                return(numpy.frombuffer(self.raw_vb, dtype = get_vb_dtype(self.fmt))[str(i)])
+        return([x['Buffer'] for x in self.vb if x['SemanticName'] == semantic_name\
+            and x['SemanticIndex'] == semantic_index][0])
+
+# The .fmt, .ib and .vb (or .vb0, .vb1...) files of a mesh, with their size, modification time and hash.
+# Paths are relative to the folder of the mesh, so that the folder can be moved.
+def mesh_cache_key(filename, fmt_struct):
+    source_files = [filename + '.fmt', filename + '.ib']
+    if 'stride' in fmt_struct:
+        source_files.append(filename + '.vb')
+    else:
+        source_files.extend([filename + '.vb' + x[2:-7] for x in fmt_struct if len(x.split('stride')) > 1])
+    key = {}
+    for source_file in source_files:
+        with open(source_file, 'rb') as f:
+            key[os.path.basename(source_file)] = [os.fstat(f.fileno()).st_size, os.fstat(f.fileno()).st_mtime_ns,\
+                hashlib.sha1(f.read()).hexdigest()]
+    return(key)
+
+# A file that has the same size and time is taken as unchanged without reading it, otherwise the hash
+# decides (e.g. files copied or checked out again, with the same contents but a new time).  When the hash
+# matches, the new time is written into key, so that the caller can save it and skip the hash next time.
+def mesh_cache_is_current(key, folder):
+    for source_file in key:
+        try:
+            with open(os.path.join(folder, source_file), 'rb') as f:
+                size, mtime = os.fstat(f.fileno()).st_size, os.fstat(f.fileno()).st_mtime_ns
+                if size != key[source_file][0]:
+                    return False
+                if mtime != key[source_file][1]:
+                    if hashlib.sha1(f.read()).hexdigest() != key[source_file][2]:
+                        return False
+                    key[source_file][1] = mtime
+        except FileNotFoundError:
+            return False
+    return True
+
+def read_cached_mesh_buffer(cache_filename, e = '<'):
+    try:
+        with numpy.load(cache_filename) as cache:
+            stored_key = str(cache['key'])
+            key = json.loads(stored_key)
+            if str(cache['e']) != e or not mesh_cache_is_current(key, os.path.dirname(cache_filename)):
+                return None
+            vb = [dict(element, Buffer = cache['vb{}'.format(i)]) for (i, element) in enumerate(json.loads(str(cache['vb_elements'])))]
+            mesh_buffer = MeshBuffer(json.loads(str(cache['fmt'])), cache['ib'], vb)
+    except (OSError, ValueError, KeyError): # Missing or damaged, parse the mesh again
+        return None
+    if json.dumps(key) != stored_key: # Files were touched but not changed, save their new times
+        write_cached_mesh_buffer(mesh_buffer, cache_filename, key, e)
+    return(mesh_buffer)
+
+def write_cached_mesh_buffer(mesh_buffer, cache_filename, key, e = '<'):
+    arrays = {'key': json.dumps(key), 'e': e, 'fmt': json.dumps(mesh_buffer.fmt), 'ib': mesh_buffer.ib,\
+        'vb_elements': json.dumps([{k:v for (k,v) in x.items() if k != 'Buffer'} for x in mesh_buffer.vb])}
+    arrays.update({'vb{}'.format(i): mesh_buffer.vb[i]['Buffer'] for i in range(len(mesh_buffer.vb))})
+    try:
+        with open(cache_filename + '.tmp', 'wb') as f:
+            numpy.savez(f, **arrays)
+        os.replace(cache_filename + '.tmp', cache_filename)
+    except OSError: # Read-only folder, etc.  The cache is only an optimization.
+        pass
+    return
+
+# With use_cache = True, the decoded arrays are kept in a sidecar file next to the mesh (filename.meshcache.npz)
+# and read from there instead while the .fmt / .ib / .vb files are unchanged.
+def read_mesh_buffer(filename, e = '<', swap_winding = False, use_mmap = False, use_cache = False):
+    cache_filename = filename + '.meshcache.npz'
+    mesh_buffer = None
+    if use_cache == True:
+        mesh_buffer = read_cached_mesh_buffer(cache_filename, e)
+    if mesh_buffer == None:
+        fmt = read_fmt(filename + '.fmt')
+        if use_cache == True:
+            key = mesh_cache_key(filename, fmt)
+        mesh_buffer = MeshBuffer(fmt, read_ib(filename + '.ib', fmt, e, True, False, use_mmap),\
+            read_vb(filename + '.vb', fmt, e, True, use_mmap))
+        if use_cache == True:
+            write_cached_mesh_buffer(mesh_buffer, cache_filename, key, e)
+    if swap_winding == True:
+        mesh_buffer.ib = swap_winding_order(mesh_buffer.ib, in_place = True)
+    return(mesh_buffer)
+
+def write_mesh_buffer(mesh_buffer, filename, e = '<', swap_winding = False):
+    write_fmt(mesh_buffer.fmt, filename + '.fmt')
+    write_ib(mesh_buffer.ib, filename + '.ib', mesh_buffer.fmt, e, swap_winding)
+    if mesh_buffer.is_raw() and e == '<':
+        with open(filename + '.vb', 'wb') as f:
+            f.write(mesh_buffer.raw_vb)
+    else:
+        write_vb(mesh_buffer.vb, filename + '.vb', mesh_buffer.fmt, e)
+    return
+
 # The following two functions are purely for convenience
 def read_struct_from_json(filename, raise_on_fail = True):
     with open(filename, 'r') as f:
@@ -0,0 +1,241 @@
+# Benchmark for lib_falcompress.py.  Compresses and decompresses synthetic data shaped like the buffers
+# found in IT3 files (VPAC vertex buffers, R16 index buffers, swizzled BC7 textures, MAT4 records and BON3
+# name tables) with every codec, and reports throughput (MB/s of uncompressed data), compression ratio and
+# peak memory use.
+# Usage:  Run by itself without commandline arguments to print the results.  Use --save_baseline to keep
+# the results in a JSON file, and --baseline to compare a later run against it (exits with an error if
+# any codec got slower or compresses worse than the tolerance allows).
+#
+# For command line options, run:
+# /path/to/python3 falcompress_benchmark.py --help
+#
+# Requires lib_falcompress.py, put in the same directory
+#
+# GitHub eArmada8/Ys8_IT3
+
+try:
+    import struct, io, json, math, random, time, tracemalloc, os, sys
+    from lib_falcompress import *
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    input("Press Enter to abort.")
+    raise
+
+# 160-byte stride vertices (fmt_bitmask 0xFFFF): position, three unused float4, normal, tangent, two colors,
+# four float4 texcoords (only the first used), blend weights and indices, and two unused dwords.
+def make_vpac_vb (rnd, count):
+    vertices = []
+    x, y, z = 0.0, 0.0, 0.0
+    for i in range(count):
+        x, y, z = x + rnd.uniform(-0.01, 0.01), y + rnd.uniform(-0.01, 0.01), z + rnd.uniform(-0.01, 0.01)
+        weights = sorted([rnd.randrange(256) for j in range(3)], reverse = True)
+        vertices.append(struct.pack("<4f48x", x, y, z, 1.0)
+            + bytes([rnd.randrange(256) for j in range(8)]) + b'\xff' * 8
+            + struct.pack("<2f56x", rnd.random(), rnd.random())
+            + bytes(weights + [0]) + bytes([rnd.randrange(64) for j in range(3)] + [0]) + bytes(8))
+    return(b''.join(vertices))
+
+# Triangle list indices, mostly walking forward through the vertex buffer like a triangle strip would
+def make_r16_ib (rnd, count):
+    indices = []
+    base = 0
+    for i in range(count):
+        base = min(base + rnd.choice([0, 1, 1, 2]), 0xFFF0)
+        indices.extend([base, base + 1 + rnd.randrange(3), base + 2 + rnd.randrange(8)])
+    return(struct.pack("<{}H".format(len(indices)), *indices))
+
+# BC7 blocks are close to random, but neighbouring blocks of smooth areas share their mode and partition
+# bits.  Blocks are generated in raster order and then reordered in Morton order, like a swizzled texture.
+def make_bc7_swizzled (rnd, width_blocks, height_blocks):
+    blocks = []
+    for i in range(width_blocks * height_blocks):
+        if len(blocks) > 0 and rnd.random() < 0.3:
+            blocks.append(blocks[-1][0:4] + bytes([rnd.randrange(256) for j in range(12)]))
+        else:
+            blocks.append(bytes([0x20 | rnd.randrange(16)] + [rnd.randrange(256) for j in range(15)]))
+    def morton (x, y):
+        return(sum([((x >> i) & 1) << (2 * i) | ((y >> i) & 1) << (2 * i + 1) for i in range(16)]))
+    order = sorted(range(len(blocks)), key = lambda i: morton(i % width_blocks, i // width_blocks))
+    return(b''.join([blocks[i] for i in order]))
+
+# 0x180-byte MAT4 records: texture names, shader parameters and flags
+def make_mat4 (rnd, count):
+    records = []
+    for i in range(count):
+        names = b''.join([rnd.choice([b'c005_body', b'c005_face', b'c005_hair', b'toon_ramp', b'']).ljust(32, b'\x00')\
+            for j in range(4)])
+        params = struct.pack("<24f", *[rnd.choice([0.0, 1.0, 0.5, rnd.random()]) for j in range(24)])
+        flags = struct.pack("<8I", *[rnd.choice([0, 1, 0x101, 0x10101]) for j in range(8)])
+        records.append((names + params + flags).ljust(0x180, b'\x00'))
+    return(b''.join(records))
+
+# BON3 joint names, 64 bytes each
+def make_bon3_names (rnd, count):
+    parts = ['spine', 'arm', 'hand', 'finger', 'leg', 'foot', 'head', 'hair', 'skirt', 'cape']
+    return(b''.join([('bone_{0}_{1}_{2:02d}'.format(rnd.choice(parts), rnd.choice(['l', 'r', 'c']), i)).encode()\
+        .ljust(64, b'\x00') for i in range(count)]))
+
+def make_corpora (scale = 1):
+    rnd = random.Random(8)
+    return({'vpac_vb': make_vpac_vb(rnd, 1024 * scale), 'r16_ib': make_r16_ib(rnd, 8192 * scale),\
+        'bc7_swizzled': make_bc7_swizzled(rnd, 64, 64 * scale), 'mat4': make_mat4(rnd, 128 * scale),\
+        'bon3_names': make_bon3_names(rnd, 512 * scale)})
+
+# lib_falcompress only decodes C77 type 2, so this is a simple greedy encoder to make input for it.
+# Token: literal count (high nibble) and match length - 4 (low nibble), each extended with 255s when 15,
+# the literals, then the u16 distance, except for the last token which is only literals.
+def encode_c77_2 (data):
+    def write_length (out, value):
+        while value >= 255:
+            out.append(255)
+            value -= 255
+        out.append(value)
+    out = bytearray()
+    last_seen = {}
+    literal_start, i = 0, 0
+    while i < len(data):
+        candidate = last_seen.get(data[i:i+4], -1)
+        last_seen[data[i:i+4]] = i
+        if candidate >= 0 and i - candidate < 0x10000 and i + 4 <= len(data) and data[candidate:candidate+4] == data[i:i+4]:
+            match_len = 4
+            while i + match_len < len(data) and data[candidate + match_len] == data[i + match_len]:
+                match_len += 1
+            literals = i - literal_start
+            out.append((min(literals, 15) << 4) | min(match_len - 4, 15))
+            if literals >= 15:
+                write_length(out, literals - 15)
+            out.extend(data[literal_start:i])
+            out.extend(struct.pack("<H", i - candidate))
+            if match_len - 4 >= 15:
+                write_length(out, match_len - 4 - 15)
+            i += match_len
+            literal_start = i
+        else:
+            i += 1
+    literals = len(data) - literal_start
+    out.append(min(literals, 15) << 4)
+    if literals >= 15:
+        write_length(out, literals - 15)
+    out.extend(data[literal_start:])
+    return(bytes(out))
+
+# Each codec splits the data into the segments the library uses, and returns (compress, decompress)
+# functions.  compress is None when the library has no encoder for the format.
+def c77_1_codec (data, optimal = False):
+    segments = [data[i:i+0x40000] for i in range(0, len(data), 0x40000)]
+    compressor = compress_data_block_optimal if optimal else compress_data_block
+    compressed = [compressor(x) for x in segments]
+    def compress():
+        return([compressor(x) for x in segments])
+    def decompress():
+        return([parse_data_block_c77_1(io.BytesIO(compressed[i]), len(compressed[i]) + 4, len(segments[i]), True)\
+            for i in range(len(segments))])
+    return(compress, decompress, sum([len(x) for x in compressed]))
+
+def c77_2_codec (data):
+    segments = [data[i:i+0x40000] for i in range(0, len(data), 0x40000)]
+    compressed = [encode_c77_2(x) for x in segments]
+    def decompress():
+        return([parse_data_block_c77_2(io.BytesIO(compressed[i]), len(compressed[i]), len(segments[i]))\
+            for i in range(len(segments))])
+    return(None, decompress, sum([len(x) for x in compressed]))
+
+def bz_mode2_codec (data, optimal = False, decoder = decompress_mode2):
+    chunks = [data[i:i+0x7FF0] for i in range(0, len(data), 0x7FF0)]
+    compressed = [compress_mode2(x, optimal) for x in chunks]
+    def compress():
+        return([compress_mode2(x, optimal) for x in chunks])
+    def decompress():
+        results = []
+        for x in compressed:
+            output = bytearray(65536)
+            decoder(x, output, len(x))
+            results.append(output)
+        return(results)
+    # The compressor is the same whichever decoder is used, so it is only timed once
+    return(compress if decoder == decompress_mode2 else None, decompress, sum([len(x) for x in compressed]))
+
+codecs = {'c77_1': c77_1_codec, 'c77_1_max': lambda x: c77_1_codec(x, optimal = True), 'c77_2': c77_2_codec,\
+    'bz_mode2': bz_mode2_codec, 'bz_mode2_max': lambda x: bz_mode2_codec(x, optimal = True),\
+    'bz_mode2_old_decoder': lambda x: bz_mode2_codec(x, decoder = decompress)}
+
+# Best time of repeat runs, and the peak memory of one more run under tracemalloc (which slows it down,
+# so it is not timed)
+def measure (function, repeat):
+    if function is None:
+        return(None, None)
+    best = math.inf
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start_time)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return(best, peak)
+
+def run_benchmark (codec_names, repeat = 3, scale = 1):
+    results = {}
+    for corpus_name, data in make_corpora(scale).items():
+        for codec_name in codec_names:
+            compress, decompress, compressed_size = codecs[codec_name](data)
+            compress_time, compress_peak = measure(compress, repeat)
+            decompress_time, decompress_peak = measure(decompress, repeat)
+            result = {'size': len(data), 'ratio': compressed_size / len(data),\
+                'compress_mb_s': len(data) / compress_time / 1e6 if compress_time else None,\
+                'decompress_mb_s': len(data) / decompress_time / 1e6,\
+                'peak_kb': max([x for x in [compress_peak, decompress_peak] if x is not None]) // 1024}
+            results['{0}/{1}'.format(corpus_name, codec_name)] = result
+            print("{0:<36} {1:>9} {2:>7.3f} {3:>12} {4:>12.2f} {5:>10}".format('{0}/{1}'.format(corpus_name, codec_name),\
+                result['size'], result['ratio'], '-' if result['compress_mb_s'] is None else\
+                '{0:.2f}'.format(result['compress_mb_s']), result['decompress_mb_s'], result['peak_kb']))
+    return(results)
+
+# Returns a list of regressions: throughput more than tolerance below the baseline, or a ratio more than
+# 1% above it (the compressors are deterministic, so any change in ratio is a real change)
+def compare_to_baseline (results, baseline, tolerance):
+    regressions = []
+    for key in results:
+        if key in baseline:
+            for measurement in ['compress_mb_s', 'decompress_mb_s']:
+                if results[key][measurement] is not None and baseline[key][measurement] is not None\
+                        and results[key][measurement] < baseline[key][measurement] * (1 - tolerance):
+                    regressions.append("{0} {1}: {2:.2f}, baseline {3:.2f}".format(key, measurement,\
+                        results[key][measurement], baseline[key][measurement]))
+            if results[key]['ratio'] > baseline[key]['ratio'] * 1.01:
+                regressions.append("{0} ratio: {1:.4f}, baseline {2:.4f}".format(key, results[key]['ratio'], baseline[key]['ratio']))
+    return(regressions)
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--codecs', help="Comma-separated codecs to run (default all but the slow _max ones): {0}"\
+        .format(', '.join(codecs)), default = 'c77_1,c77_2,bz_mode2,bz_mode2_old_decoder')
+    parser.add_argument('-r', '--repeat', help="Timed runs per measurement, the best is kept (default 3)", type=int, default=3)
+    parser.add_argument('-s', '--scale', help="Multiplies the size of every corpus (default 1)", type=int, default=1)
+    parser.add_argument('-b', '--baseline', help="JSON file from --save_baseline to compare against")
+    parser.add_argument('-t', '--tolerance', help="Allowed slowdown against the baseline (default 0.3 = 30%%)", type=float, default=0.3)
+    parser.add_argument('--save_baseline', help="Save the results to this JSON file")
+    args = parser.parse_args()
+    print("{0:<36} {1:>9} {2:>7} {3:>12} {4:>12} {5:>10}".format('corpus/codec', 'bytes', 'ratio', 'comp MB/s', 'decomp MB/s', 'peak KB'))
+    results = run_benchmark(args.codecs.split(','), repeat = args.repeat, scale = args.scale)
+    if args.save_baseline:
+        with open(args.save_baseline, 'wb') as f:
+            f.write(json.dumps(results, indent=4).encode("utf-8"))
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            regressions = compare_to_baseline(results, json.loads(f.read()), args.tolerance)
+        if len(regressions) > 0:
+            print("Regressions against {0}:".format(args.baseline))
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        else:
+            print("No regressions against {0}.".format(args.baseline))
@@ -64,10 +64,10 @@ def optimize(sets: typing.Iterable[fsi], size: int) -> typing.Iterable[fsi]:
 def optimal_vertex_group_segments(all_group_sets, size = 4):
     return [tuple(x) for x in list(optimize({fsi(x) for x in all_group_sets}, size = size))]
 
-def segment_mesh (mesh_filename, max_group = 4, clean_vg_indices = True):
-    fmt = read_fmt(mesh_filename+'.fmt')
-    ib = read_ib(mesh_filename+'.ib',fmt)
-    vb = read_vb(mesh_filename+'.vb',fmt)
+def segment_mesh (mesh_filename, max_group = 4, clean_vg_indices = True, use_cache = True):
+    # Decoded buffers are cached next to the mesh (.meshcache.npz), see read_mesh_buffer in lib_fmtibvb.py
+    mesh = read_mesh_buffer(mesh_filename, use_cache = use_cache)
+    fmt, ib, vb = mesh['fmt'], mesh['ib'], mesh['vb']
     vgmap = json.loads(open(mesh_filename+'.vgmap').read())
     semantics = [x['SemanticName'] for x in vb]
     if 'BLENDINDICES' in semantics:
@@ -133,6 +133,7 @@ if __name__ == "__main__":
     if len(sys.argv) > 1:
         import argparse
         parser = argparse.ArgumentParser()
+        parser.add_argument('-u', '--no_cache', help="Do not reuse or save the decoded mesh between runs", action="store_true")
         parser.add_argument('mesh_vb_filename', help="Name of mesh .vb file to split (required).")
         args = parser.parse_args()
         if os.path.exists(args.mesh_vb_filename) and args.mesh_vb_filename[-3:].lower() == '.vb':
@@ -140,7 +141,7 @@ if __name__ == "__main__":
             if os.path.exists(mesh_filename+'.fmt')\
                 and os.path.exists(mesh_filename+'.ib')\
                 and os.path.exists(mesh_filename+'.vgmap'): 
-                segment_mesh(mesh_filename)
+                segment_mesh(mesh_filename, use_cache = not args.no_cache)
     else:
         mesh_files = glob.glob('*.vb')
         for i in range(len(mesh_files)):
@@ -11,7 +11,8 @@
 # GitHub eArmada8/Ys8_IT3
 
 try:
-    import struct, math, base64, io, json, os, sys, glob
+    import struct, math, base64, io, json, numpy, os, sys, glob, mmap, contextlib
+    from concurrent.futures import ProcessPoolExecutor, as_completed
     from itertools import chain
     from lib_falcompress import *
     from lib_fmtibvb import *
@@ -142,9 +143,10 @@ def make_vpa8_fmt():
     'InstanceDataStepRate': '0'}]})
 
 def parse_info_block (f):
-    return {'name': f.read(64).split(b'\x00')[0].decode('ASCII'),\
-        'matrix': [list(struct.unpack("<4f", f.read(16))) for x in range(4)],\
-        'v0': list(struct.unpack("<3f", f.read(12)))}
+    values = struct.unpack("<64s16f3f", f.read(140))
+    return {'name': values[0].split(b'\x00')[0].decode('ASCII'),\
+        'matrix': [list(values[1+x*4:5+x*4]) for x in range(4)],\
+        'v0': list(values[17:20])}
 
 def parse_rty2_block (f):
     return {'material_variant': struct.unpack("<I", f.read(4))[0],\
@@ -335,10 +337,10 @@ def parse_vpa78_block (f, block_type):
         size2, = struct.unpack("<I", f.read(4))
         with io.BytesIO(parse_data_blocks(f)) as ff:
             p_arr_v = [struct.unpack("<4f4I8f13I", ff.read(116)) for i in range(count)]
-        buffer_v = b''.join([parse_data_blocks(f) for i in range(math.ceil(size1 / 0x40000))]) # len(data1) == size1
+        buffer_v = b''.join(chain.from_iterable(iter_data_blocks(f) for i in range(math.ceil(size1 / 0x40000)))) # len(data1) == size1
         with io.BytesIO(parse_data_blocks(f)) as ff:
             p_arr_i = [struct.unpack("<3I", ff.read(12)) for i in range(count)]
-        buffer_i = b''.join([parse_data_blocks(f) for i in range(math.ceil(size2 / 0x40000))]) # len(data2) * 2 == size2
+        buffer_i = b''.join(chain.from_iterable(iter_data_blocks(f) for i in range(math.ceil(size2 / 0x40000)))) # len(data2) * 2 == size2
     fmt_struct = make_vpa8_fmt()
     section_info = []
     mesh_buffers = []
@@ -358,38 +360,58 @@ def parse_vpa78_block (f, block_type):
                 'i_unk0': p_arr_i[i][0], 'num_indices': p_arr_i[i][1], 'i_unk1': p_arr_i[i][2] }
         mesh["block_size"] = fmt_struct['stride']
         mesh["vertex_count"] = mesh["header"]["num_vertices"]
-        ib = read_ib_stream(buffer_i[pointer_i:pointer_i+mesh["header"]["num_indices"]*2], fmt_struct)
-        vb = read_vb_stream(buffer_v[pointer_v:pointer_v+mesh["header"]["num_vertices"]*40], fmt_struct)
+        ib = read_ib_stream(buffer_i[pointer_i:pointer_i+mesh["header"]["num_indices"]*2], fmt_struct, as_arrays = True)
+        vb = read_vb_stream(buffer_v[pointer_v:pointer_v+mesh["header"]["num_vertices"]*40], fmt_struct, as_arrays = True)
         # Map bone palette to mesh global indices
-        to_global = [0] + list(mesh["header"]['bone_palette'])
+        to_global = numpy.array([0] + list(mesh["header"]['bone_palette']))
         try:
-            for j in range(len(vb[4]['Buffer'])):
-                vb[4]['Buffer'][j] = [to_global[x]//3 for x in vb[4]['Buffer'][j]]
+            vb[4]['Buffer'] = to_global[vb[4]['Buffer']]//3
         except IndexError:
             print("Unable to convert local bone indices to mesh global, skipping...")
         section_info.append(mesh)
-        mesh_buffers.append({'fmt': fmt_struct, 'ib': ib, 'vb': vb, 'material': mesh["header"]["material_id"]})
+        mesh_buffers.append(MeshBuffer(fmt_struct, ib, vb, material = mesh["header"]["material_id"]))
         pointer_i += mesh["header"]["num_indices"]*2
         pointer_v += mesh["header"]["num_vertices"]*40
     return(section_info, mesh_buffers)
 
-def parse_vpax_block (f, block_type, trim_for_gpu = False):
+# The VPAC header is 72 bytes plus 16 bytes per attribute plus 36 bytes, this covers far more attributes
+# than the 20 bits of fmt_bitmask can describe.
+vpac_header_max_size = 0x400
+
+# With header_only, only the start of each vertex buffer is decompressed and the index buffers are not
+# read at all, so section_info is filled in and mesh_buffers is left empty.  With more than one submesh and
+# more than one decompression worker, every buffer is copied out first and they are all decompressed in
+# parallel, and each submesh is decoded as soon as its own buffers are ready.  (With a single submesh, the
+# blocks within its vertex buffer are decompressed in parallel instead, see iter_data_blocks.)
+def parse_vpax_block (f, block_type, trim_for_gpu = False, header_only = False):
     count, = struct.unpack("<I", f.read(4))
     indices = []
     vertices = []
     mesh_buffers = []
+    pipelined = (header_only == False and block_type != 'VPAU' and count > 1 and get_decompression_pool() is not None)
     for i in range(count):
-        print("Decompressing vertex buffer {0}".format(i))
+        if header_only == False:
+            print("Decompressing vertex buffer {0}".format(i))
         size, = struct.unpack("<I", f.read(4))
         blocks = 1
         if block_type == 'VPA9':
             blocks = math.ceil(size / 0x40000)
         if block_type == 'VPAU':
-            data = f.read(size)
+            if header_only == True:
+                data = f.read(min(size, vpac_header_max_size))
+                f.seek(size - len(data), 1)
+            else:
+                data = f.read(size)
+        elif header_only == True:
+            data = read_range(f, 0, vpac_header_max_size)
+            for j in range(blocks - 1):
+                skip_data_blocks(f)
+        elif pipelined == True:
+            data = submit_decompression(read_data_blocks_compressed(f, blocks), blocks)
         else:
-            data = b''.join([parse_data_blocks(f) for i in range(blocks)])
+            data = b''.join(chain.from_iterable(iter_data_blocks(f) for i in range(blocks)))
         vertices.append(data)
-    for i in range(count):
+    for i in range([count, 0][header_only]):
         print("Decompressing index buffer {0}".format(i))
         size, = struct.unpack("<I", f.read(4))
         blocks = 1
@@ -397,11 +419,15 @@ def parse_vpax_block (f, block_type, trim_for_gpu = False):
             blocks = math.ceil(size / 0x40000)
         if block_type == 'VPAU':
             data = f.read(size * 2)
+        elif pipelined == True:
+            data = submit_decompression(read_data_blocks_compressed(f, blocks), blocks)
         else:
-            data = b''.join([parse_data_blocks(f) for i in range(blocks)])
+            data = b''.join(chain.from_iterable(iter_data_blocks(f) for i in range(blocks)))
         indices.append(data)
     section_info = []
     for i in range(count):
+        if pipelined == True:
+            vertices[i], indices[i] = vertices[i].result(), indices[i].result()
         with io.BytesIO(vertices[i]) as vb_stream:
             mesh = {}
             mesh["header"] = {'name': vb_stream.read(4).decode('ASCII'), 'version': struct.unpack("<I", vb_stream.read(4))[0],\
@@ -416,19 +442,19 @@ def parse_vpax_block (f, block_type, trim_for_gpu = False):
             mesh["header"]["attr_bitmask"] = list(struct.unpack("<{}I".format(n_attr), vb_stream.read(n_attr * 4)))
             mesh["header"]["material_id"], = struct.unpack("<I", vb_stream.read(4))
             mesh["header"]["unk"] = list(struct.unpack("<8I", vb_stream.read(32)))
-            if mesh["header"]["name"] == 'VPAC':
+            if mesh["header"]["name"] == 'VPAC' and header_only == False:
                 fmt_struct = make_fmt(mesh["header"]["fmt_bitmask"], game_version = {'VPA9':1, 'VPAX':1, 'VP11':2, 'VPAU':1}[block_type])
                 mesh["block_size"] = int(fmt_struct['stride'])
-                #vb = vb_stream.read(mesh["block_size"] * mesh["header"]["vertex_count"])
-                vb = read_vb_stream(vb_stream.read(), fmt_struct, e = '<')
-                ib = read_ib_stream(indices[i], fmt_struct, e = '<')
+                ib = read_ib_stream(indices[i], fmt_struct, e = '<', as_arrays = True)
                 if trim_for_gpu == True and fmt_struct['stride'] == '160':
-                    mesh_buffers.append({'fmt': make_88_fmt(), 'ib': ib,\
-                        'vb': [vb[i] for i in [0,1,4,5,6,7,8,9,12,14]],\
-                        'material': mesh["header"]["material_id"]})
+                    vb = read_vb_stream(vb_stream.read(), fmt_struct, e = '<', as_arrays = True)
+                    mesh_buffers.append(MeshBuffer(make_88_fmt(), ib, [vb[i] for i in [0,1,4,5,6,7,8,9,12,14]],\
+                        material = mesh["header"]["material_id"]))
                 else:
-                    mesh_buffers.append({'fmt': fmt_struct, 'ib': ib, 'vb': vb, 'material': mesh["header"]["material_id"],
-                        'fmt_bitmask': mesh["header"]["fmt_bitmask"]})
+                    # The vertices after the header are already laid out as fmt_struct describes, so they are
+                    # kept as they are and only decoded if something asks for mesh_buffer.vb
+                    mesh_buffers.append(MeshBuffer(fmt_struct, ib, raw_vb = memoryview(vertices[i])[vb_stream.tell():],\
+                        material = mesh["header"]["material_id"], fmt_bitmask = mesh["header"]["fmt_bitmask"]))
             section_info.append(mesh)
     return(section_info, mesh_buffers)
 
@@ -462,14 +488,14 @@ def obtain_mesh_data (f, it3_contents, it3_filename, preserve_gl_order = False,
         else:
             it3_contents[vpax_blocks[i]]["data"], mesh_data = parse_vpax_block(f, it3_contents[vpax_blocks[i]]['type'], trim_for_gpu)
             # For some reason Ys VIII starts numbering at 1 (root is node 1, not node 0)
-            node_list = [it3_filename[:-4]]
+            node_list = [os.path.basename(it3_filename)[:-4]]
         if it3_contents[vpax_blocks[i]]['info_name'] in mat_blocks:
             for j in range(len(mesh_data)):
                 if mesh_data[j]['material'] < len(mat_blocks[it3_contents[vpax_blocks[i]]['info_name']]):
                     mesh_data[j]['material'] = mat_blocks[it3_contents[vpax_blocks[i]]['info_name']][mesh_data[j]['material']]
         if preserve_gl_order == False: # Swap triangles from OpenGL to D3D order
             for j in range(len(mesh_data)):
-                mesh_data[j]['ib'] = [[x[0],x[2],x[1]] for x in mesh_data[j]['ib']]
+                mesh_data[j].ib = swap_winding_order(mesh_data[j].ib)
         bone_section = [x for x in it3_contents if x['type'] == 'BON3'\
             and x['info_name'] == it3_contents[vpax_blocks[i]]['info_name']]
         if len(bone_section) > 0:
@@ -480,13 +506,10 @@ def obtain_mesh_data (f, it3_contents, it3_filename, preserve_gl_order = False,
 
 def write_fmt_ib_vb (mesh_buffer, filename, node_list = [], complete_maps = False):
     print("Writing submesh {0}".format(filename))
-    write_fmt(mesh_buffer['fmt'], filename + '.fmt')
-    write_ib(mesh_buffer['ib'], filename +  '.ib', mesh_buffer['fmt'])
-    write_vb(mesh_buffer['vb'], filename +  '.vb', mesh_buffer['fmt'])
+    write_mesh_buffer(mesh_buffer, filename)
     if len(node_list) > 0:
         # Find vertex groups referenced by vertices so that we can cull the empty ones
-        active_nodes = list(set(list(chain.from_iterable([x["Buffer"] for x in mesh_buffer["vb"] \
-            if x["SemanticName"] == 'BLENDINDICES'][0]))))
+        active_nodes = numpy.unique(mesh_buffer.get_buffer('BLENDINDICES')).tolist()
         vgmap_json = {}
         for i in range(len(node_list)):
             if (i in active_nodes) or (complete_maps == True):
@@ -558,7 +581,7 @@ def parse_texi_block (f):
     section_info = []
     valid_bpps = [0,1,2,4,5,6,7,8,10]
     bpp_multipliers = {0:8,1:8,2:8,4:0x10,5:0x20,6:4,7:8,8:8,10:8}
-    texture_data = bytes()
+    texture_data = bytearray()
     num_mipmaps = 0 #DDS convention, count includes the primary texture image
     if f.read(4) == b'ITP\xff':
         while True:
@@ -589,7 +612,8 @@ def parse_texi_block (f):
                     if (ihdr[0]['data']['compression_type'] & 0xFFFFFF00):
                         section["data"]["bug_report"] = 'Not expected in TwnKey\'s code'
                         section["data"]["unk1"], section["data"]["unk2"] = struct.unpack("<2I", f.read(8))
-                        texture_data += parse_data_blocks(f)
+                        for block in iter_data_blocks(f):
+                            texture_data.extend(block)
                     else:
                         rawtexdata = bytes()
                         if ihdr[0]['data']['compression_type'] in [2,3,4]:
@@ -604,7 +628,7 @@ def parse_texi_block (f):
                         if len(rawtexdata) > 0:
                             if ihdr[0]['data']['pixel_format'] == 4:
                                 rawtexdata = unswizzle(rawtexdata, ihdr[0]['data']['dwHeight'], ihdr[0]['data']['dwWidth'], block_size)
-                            texture_data += rawtexdata
+                            texture_data.extend(rawtexdata)
                             num_mipmaps += 1
                     if mipmap_num == 0:
                         linear_size = len(texture_data)
@@ -621,7 +645,7 @@ def parse_texi_block (f):
             else:
                 section_info.append(section)
         if len(texture_data) > 0:
-            texture = dds_header(ihdr[0]['data']['dwHeight'], ihdr[0]['data']['dwWidth'], linear_size, num_mipmaps) + texture_data
+            texture = dds_header(ihdr[0]['data']['dwHeight'], ihdr[0]['data']['dwWidth'], linear_size, num_mipmaps) + bytes(texture_data)
         else:
             texture = b''
     else:
@@ -637,9 +661,8 @@ def obtain_textures (f, it3_contents):
             it3_contents[texi_blocks[i]]['texture_name'] = f.read(36).split(b'\x00')[0].decode('ASCII')
         else: #'TEX2'
             f.seek(4,1) #unk int
-            name = f.read(1)
-            while not name[-1:] == b'\x00':
-                name += f.read(1)
+            name_end = f.find(b'\x00', f.tell())
+            name = f.read((name_end if name_end > -1 else len(f)) - f.tell() + 1)
             it3_contents[texi_blocks[i]]['texture_name'] = name.rstrip(b'\x00').decode('ASCII')
         print("Processing texture {0}".format(it3_contents[texi_blocks[i]]['texture_name']))
         start_offset = f.tell()
@@ -655,63 +678,146 @@ def obtain_textures (f, it3_contents):
         textures.append(tex_block)
     return(it3_contents, textures)
 
-def parse_it3 (f):
-    file_length = f.seek(0,2)
-    f.seek(0,0)
-    contents = []
-    info_section = ''
-    while f.tell() < file_length:
-        current_offset = f.tell()
-        section_info = {}
-        section_info["type"] = f.read(4).decode('ASCII')
-        section_info["size"], = struct.unpack("<I",f.read(4))
-        section_info["section_start_offset"] = f.tell()
-        if section_info["type"] == 'INFO':
-            section_info["data"] = parse_info_block(f)
-            info_section = section_info["data"]["name"]
-        else:
+# Parsers for the sections that It3Index can decode by itself.  Mesh and texture sections are decoded
+# by obtain_mesh_data() and obtain_textures(), which set 'data' directly.
+it3_section_parsers = {'INFO': parse_info_block, 'RTY2': parse_rty2_block, 'RTY3': parse_rty3_block,\
+    'LIG3': parse_lig3_block, 'INFY': parse_infy_block, 'INFZ': parse_infz_block, 'BBOX': parse_bbox_block,\
+    'CHID': parse_chid_block, 'JNTV': parse_jntv_block, 'MAT4': parse_mat4_block, 'MAT6': parse_mat6_block,\
+    'MATU': parse_matu_block, 'BON3': parse_bon3_block}
+
+# A single section of an IT3 file.  'data' is parsed from the file the first time it is read, then kept.
+class It3Section(dict):
+    __slots__ = ('f',)
+
+    def __init__(self, f, **fields):
+        super().__init__(**fields)
+        self.f = f
+
+    def __missing__(self, key):
+        if key == 'data' and self['type'] in it3_section_parsers:
+            current_offset = self.f.tell()
+            self.f.seek(self['section_start_offset'], 0)
+            self['data'] = it3_section_parsers[self['type']](self.f)
+            self.f.seek(current_offset, 0)
+            return(self['data'])
+        raise KeyError(key)
+
+# List of every section in an IT3 file, built from the section headers alone (only the name of each INFO
+# node is read, so that every section knows which node it belongs to).  The headers are unpacked in place
+# from the memory map; a plain file is mapped first, and that map belongs to the index (use it in a with
+# block, or call close()).  Section data is decoded on demand, so the map must stay open while 'data' is
+# being read.
+class It3Index(list):
+    def __init__(self, f):
+        super().__init__()
+        self.owns_map = not isinstance(f, mmap.mmap)
+        if self.owns_map:
+            f = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.f = f
+        self.file_length = len(f)
+        info_section = ''
+        offset = 0
+        while offset < self.file_length:
+            if offset + 8 > self.file_length:
+                raise ValueError("{0} bytes left over at the end of the IT3 file (offset {1})".format(\
+                    self.file_length - offset, offset))
+            section_type, size = struct.unpack_from("<4sI", f, offset)
+            if offset + 8 + size > self.file_length:
+                raise ValueError("Section {0} at offset {1} is {2} bytes long, past the end of the IT3 file".format(\
+                    section_type.decode('ASCII', 'replace'), offset, size))
+            section_info = It3Section(f, type = section_type.decode('ASCII'), size = size, section_start_offset = offset + 8)
+            if section_info['type'] == 'INFO':
+                info_section = f[offset+8:offset+72].split(b'\x00')[0].decode('ASCII')
             section_info["info_name"] = info_section
-        if section_info["type"] == 'RTY2':
-            section_info["data"] = parse_rty2_block(f)
-        elif section_info["type"] == 'RTY3':
-            section_info["data"] = parse_rty3_block(f)
-        elif section_info["type"] == 'LIG3':
-            section_info["data"] = parse_lig3_block(f)
-        elif section_info["type"] == 'INFY':
-            section_info["data"] = parse_infy_block(f)
-        elif section_info["type"] == 'INFZ':
-            section_info["data"] = parse_infz_block(f)
-        elif section_info["type"] == 'BBOX':
-            section_info["data"] = parse_bbox_block(f)
-        elif section_info["type"] == 'CHID':
-            section_info["data"] = parse_chid_block(f)
-        elif section_info["type"] == 'JNTV':
-            section_info["data"] = parse_jntv_block(f)
-        elif section_info["type"] == 'MAT4':
-            section_info["data"] = parse_mat4_block(f)
-        elif section_info["type"] == 'MAT6':
-            section_info["data"] = parse_mat6_block(f)
-        elif section_info["type"] == 'MATU':
-            section_info["data"] = parse_matu_block(f)
-        elif section_info["type"] == 'BON3':
-            section_info["data"] = parse_bon3_block(f)
-        #elif section_info["type"] == 'KAN7':
-            #section_info["data"] = parse_kan7_block(f)
-        contents.append(section_info)
-        f.seek(section_info["section_start_offset"] + section_info["size"], 0) # Move forward to the next section
-    return(contents)
-
-def process_it3 (it3_filename, complete_maps = complete_vgmaps_default, preserve_gl_order = False, trim_for_gpu = False, always_write_itp = False, overwrite = False):
+            self.append(section_info)
+            offset += 8 + size # Move forward to the next section
+
+    # Returns the sections of the given types, optionally only those belonging to one INFO node
+    def find (self, types, info_name = None):
+        return([x for x in self if x['type'] in types and (info_name == None or x['info_name'] == info_name)])
+
+    # Groups the sections by INFO node: {name: {'offset', 'length', 'contents' (types), 'offsets'}}
+    def nodes (self):
+        if len(self) == 0 or self[0]['type'] != 'INFO':
+            raise ValueError("IT3 file does not start with an INFO section")
+        contents = {}
+        info_section = ''
+        for section_info in self:
+            if section_info['type'] == 'INFO':
+                if info_section != '':
+                    contents[info_section]['length'] = section_info["section_start_offset"] - 8 - contents[info_section]['offset']
+                info_section = section_info['info_name']
+                contents[info_section] = {'offset': section_info["section_start_offset"]-8, 'contents': [], 'offsets': []}
+            else:
+                contents[info_section]['contents'].append(section_info['type'])
+                contents[info_section]['offsets'].append(section_info["section_start_offset"])
+        contents[info_section]['length'] = self.file_length - contents[info_section]['offset']
+        return(contents)
+
+    # Decodes the data of every section of the given types now, for use after the file is closed
+    def load (self, types = list(it3_section_parsers.keys())):
+        for section_info in self.find(types):
+            _ = section_info['data']
+        return(self)
+
+    # Closes the map if the index made it; a map handed in by the caller is left to the caller
+    def close (self):
+        if self.owns_map:
+            self.f.close()
+        return
+
+    def __enter__ (self):
+        return(self)
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.close()
+        return(False)
+
+# Memory-maps an IT3 file for reading.  The map can be used in place of an open file (read, seek, tell) by
+# every parser here, but reads are served straight from the page cache instead of one call per read.
+def map_it3 (it3_filename):
+    with open(it3_filename, 'rb') as f:
+        return(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
+def parse_it3 (f):
+    return(It3Index(f))
+
+# Prints the submeshes of every mesh section, decompressing only the VPAC headers where possible
+def list_meshes (it3_filename):
+    with map_it3(it3_filename) as f:
+        it3_contents = parse_it3(f)
+        vpax_blocks = [i for i in range(len(it3_contents)) if it3_contents[i]['type']
+            in ['VPA7', 'VPA8', 'VPA9', 'VPAX', 'VP11', 'VPAU']]
+        for i in range(len(vpax_blocks)):
+            f.seek(it3_contents[vpax_blocks[i]]['section_start_offset'])
+            if it3_contents[vpax_blocks[i]]['type'] in ['VPA7', 'VPA8']:
+                section_info, mesh_data = parse_vpa78_block(f, it3_contents[vpax_blocks[i]]['type'])
+                vertex_counts = [x['header']['num_vertices'] for x in section_info]
+            else:
+                section_info, mesh_data = parse_vpax_block(f, it3_contents[vpax_blocks[i]]['type'], header_only = True)
+                vertex_counts = [x['header']['vertex_count'] for x in section_info]
+            print("{0} ({1}):".format(it3_contents[vpax_blocks[i]]['info_name'], it3_contents[vpax_blocks[i]]['type']))
+            for j in range(len(section_info)):
+                print("  {0:02d}: {1} vertices, material {2}, fmt_bitmask {3}".format(j, vertex_counts[j],\
+                    section_info[j]['header']['material_id'], hex(section_info[j]['header'].get('fmt_bitmask', 0))))
+    return
+
+# Returns True if the file was exported, False if it was skipped because its folder exists.  With
+# ask_overwrite = False, existing folders are skipped without prompting (unless overwrite is set).
+def process_it3 (it3_filename, complete_maps = complete_vgmaps_default, preserve_gl_order = False, trim_for_gpu = False, always_write_itp = False, overwrite = False, ask_overwrite = True):
     print("Processing {0}".format(it3_filename))
-    if os.path.exists(it3_filename[:-4]) and (os.path.isdir(it3_filename[:-4])) and (overwrite == False):
+    if os.path.exists(it3_filename[:-4]) and (os.path.isdir(it3_filename[:-4])) and (overwrite == False) and (ask_overwrite == True):
         if str(input(it3_filename[:-4] + " folder exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
             overwrite = True
     if (overwrite == True) or not os.path.exists(it3_filename[:-4]):
-        with open(it3_filename, 'rb') as f:
+        with map_it3(it3_filename) as f:
             it3_contents = parse_it3(f)
+            if len(it3_contents) == 0 or it3_contents[0]['type'] != 'INFO':
+                raise ValueError("{0} does not start with an INFO section, it is not a model".format(it3_filename))
             it3_contents, meshes = obtain_mesh_data(f, it3_contents, it3_filename,\
                 preserve_gl_order = preserve_gl_order, trim_for_gpu = trim_for_gpu)
             it3_contents, textures = obtain_textures(f, it3_contents)
+            it3_contents.load(['RTY2', 'RTY3'])
             if not os.path.exists(it3_filename[:-4]):
                 os.mkdir(it3_filename[:-4])
         #with open(it3_filename[:-4] + '/container_info.json', 'wb') as f:
@@ -757,7 +863,57 @@ def process_it3 (it3_filename, complete_maps = complete_vgmaps_default, preserve
                 with open(it3_filename[:-4] + '/textures/{0}.itp'.format(safe_filename), 'wb') as f:
                     f.write(textures[i]["itp"])
             write_struct_to_json(use_alpha, it3_filename[:-4] + '/textures/__alpha_data')
-    return
+        return(True)
+    return(False)
+
+# Expands the command line paths into a list of .it3 files.  Directories are searched recursively, and
+# wildcards are expanded here as well since the Windows command prompt leaves them to the program.
+def find_it3_files (paths):
+    it3_files = []
+    for path in paths:
+        matches = []
+        for match in sorted(glob.glob(path, recursive = True)) or ([path] if os.path.exists(path) else []):
+            if os.path.isdir(match):
+                matches.extend(sorted(glob.glob(os.path.join(glob.escape(match), '**', '*.it3'), recursive = True)))
+            else:
+                matches.append(match)
+        it3_files.extend([os.path.normpath(x) for x in matches if x[-4:].lower() == '.it3' and os.path.isfile(x)])
+    return(list(dict.fromkeys(it3_files))) # Remove duplicates, keeping the order
+
+# Exports a single file for export_batch(), in a worker process when running in parallel.  The output
+# of the export itself is discarded, only the outcome is returned: (filename, status, error message).
+def export_batch_worker (it3_filename, options):
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            exported = process_it3(it3_filename, ask_overwrite = False, **options)
+        return((it3_filename, 'exported' if exported else 'skipped', ''))
+    except Exception as e:
+        return((it3_filename, 'failed', '{0}: {1}'.format(type(e).__name__, e)))
+
+# Exports many files with up to jobs worker processes (0 = all cores), one file per process.  Existing
+# folders are skipped unless overwrite is set, so nothing waits for input.  Prints a line per file as it
+# finishes, then a summary.  Returns the list of files that failed.
+def export_batch (it3_files, jobs = 1, **options):
+    jobs = max(1, jobs if jobs > 0 else (os.cpu_count() or 1))
+    results = []
+    def report (result):
+        results.append(result)
+        print("[{0}/{1}] {2}: {3}{4}".format(len(results), len(it3_files), result[0], result[1],\
+            ' ({0})'.format(result[2]) if result[2] != '' else ''))
+    if jobs == 1 or len(it3_files) == 1:
+        for it3_filename in it3_files:
+            report(export_batch_worker(it3_filename, options))
+    else:
+        with ProcessPoolExecutor(max_workers = min(jobs, len(it3_files))) as pool:
+            futures = [pool.submit(export_batch_worker, x, options) for x in it3_files]
+            for future in as_completed(futures):
+                report(future.result())
+    failed = [x for x in results if x[1] == 'failed']
+    print("{0} exported, {1} skipped (folder exists, use -o to overwrite), {2} failed.".format(\
+        len([x for x in results if x[1] == 'exported']), len([x for x in results if x[1] == 'skipped']), len(failed)))
+    for result in sorted(failed):
+        print("  Failed: {0} ({1})".format(result[0], result[2]))
+    return([x[0] for x in failed])
 
 if __name__ == "__main__":
     # Set current directory
@@ -778,15 +934,32 @@ if __name__ == "__main__":
         parser.add_argument('-t', '--trim_for_gpu', help="Trim vertex buffer for GPU injection (3DMigoto)", action="store_true")
         parser.add_argument('-i', '--always_write_itp', help="Output raw ITP files even when writing DDS textures", action="store_true")
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
-        parser.add_argument('it3_filename', help="Name of it3 file to export from (required).")
+        parser.add_argument('-l', '--list', help="List meshes without exporting", action="store_true")
+        parser.add_argument('-j', '--jobs', help="Number of processes to use, for several files at once or else for decompression (0 = all cores, default 1)", type=int, default=1)
+        parser.add_argument('it3_filename', nargs='+', help="Name of it3 file to export from (required).  Several files, folders (searched recursively) and wildcards can be given.")
         args = parser.parse_args()
         if complete_vgmaps_default == True:
             complete_maps = args.partialmaps
         else:
             complete_maps = args.completemaps
-        if os.path.exists(args.it3_filename) and args.it3_filename[-4:].lower() == '.it3':
-            process_it3(args.it3_filename, complete_maps = complete_maps, preserve_gl_order = args.preserve_gl_order, \
+        it3_files = find_it3_files(args.it3_filename)
+        if len(it3_files) == 0:
+            print("No .it3 files found!")
+        elif args.list == True:
+            set_decompression_workers(args.jobs)
+            for i in range(len(it3_files)):
+                list_meshes(it3_files[i])
+        elif len(args.it3_filename) == 1 and os.path.isfile(args.it3_filename[0]):
+            set_decompression_workers(args.jobs)
+            process_it3(it3_files[0], complete_maps = complete_maps, preserve_gl_order = args.preserve_gl_order, \
                 trim_for_gpu = args.trim_for_gpu, always_write_itp = args.always_write_itp, overwrite = args.overwrite)
+        else:
+            # The jobs are spread over the files, each file is decompressed in a single process
+            failed = export_batch(it3_files, jobs = args.jobs, complete_maps = complete_maps, \
+                preserve_gl_order = args.preserve_gl_order, trim_for_gpu = args.trim_for_gpu, \
+                always_write_itp = args.always_write_itp, overwrite = args.overwrite)
+            if len(failed) > 0:
+                sys.exit(1)
     else:
         it3_files = glob.glob('*.it3')
         for i in range(len(it3_files)):
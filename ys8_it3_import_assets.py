@@ -24,6 +24,13 @@ except ModuleNotFoundError as e:
     input("Press Enter to abort.")
     raise   
 
+# Compressed blocks are cached here (next to the script) between runs, so that unchanged meshes and textures
+# are not compressed again.  Set the size limit in bytes; the least recently used blocks are deleted past it.
+compression_cache_folder = '_compression_cache'
+compression_cache_max_size = 512 * 1024 * 1024
+# Decoded submeshes are cached next to each mesh (.meshcache.npz) and reused while the fmt / ib / vb are unchanged.
+mesh_cache = True
+
 def swizzle (texture_data, dwHeight, dwWidth, block_size):
     morton_seq = [morton(x,8,8) for x in range(64)]
     output = bytearray(dwHeight * dwWidth // (16 // block_size))
@@ -212,7 +219,8 @@ def create_vpa78 (submeshes, bonemap, block_type = 'VPA8'):
     bbox_block = b'BBOX' + struct.pack("<I", 48) + struct.pack("<12f", *[x for y in bbox_array for x in y])
     return(vpa_block, bbox_block, materials)
 
-# Acceptable block types include 'VPA9', 'VPAX', 'VPAU', 'VP11'
+# Acceptable block types include 'VPA9', 'VPAX', 'VPAU', 'VP11'.  submeshes are MeshBuffers, and the
+# buffers are only used as arrays so that memory mapped .vb / .ib files are never turned into lists.
 def create_vpax (submeshes, block_type = 'VPAX'):
     attr_format = [1, 1, 1, 1, 2, 2, 3, 3, 1, 1, 1, 1, 3, 3, 3, 3, 1, 1, 1, 1]
     attr_offset = [0, 16, 32, 48, 64, 68, 72, 76, 80, 96, 112, 128, 144, 148, 152, 156, 160, 172, 184, 192]
@@ -236,16 +244,15 @@ def create_vpax (submeshes, block_type = 'VPAX'):
         stride_semantic = 'vb0 stride' if 'vb0 stride' in submeshes[i]['fmt'] else 'stride'
         pos_i = [j for j in range(len(submeshes[i]['fmt']['elements'])) if submeshes[i]['fmt']['elements'][j]['SemanticName'] == 'POSITION'][0]
         if (submeshes[i]['fmt'][stride_semantic] == expected_fmt['stride']
-                and submeshes[i]['vb'][0]['SemanticName'] == expected_fmt['elements'][0]['SemanticName']):
+                and submeshes[i].vb[0]['SemanticName'] == expected_fmt['elements'][0]['SemanticName']):
             #Enforce correct index size for VPAX and VP11
             submeshes[i]['fmt']['format'] = {'VPA9': 'DXGI_FORMAT_R16_UINT', 'VPAX': 'DXGI_FORMAT_R16_UINT',
                 'VPAU': 'DXGI_FORMAT_R16_UINT', 'VP11': 'DXGI_FORMAT_R32_UINT'}[block_type]
             if not submeshes[i]['material']['material_name'] in [x['material_name'] for x in materials]:
                 materials.append(submeshes[i]['material'])
-            bbox_min = [min(x[0] for x in submeshes[i]['vb'][pos_i]['Buffer']), min(x[1] for x in submeshes[i]['vb'][pos_i]['Buffer']),\
-                min(x[2] for x in submeshes[i]['vb'][pos_i]['Buffer']), 0.0]
-            bbox_max = [max(x[0] for x in submeshes[i]['vb'][pos_i]['Buffer']), max(x[1] for x in submeshes[i]['vb'][pos_i]['Buffer']),\
-                max(x[2] for x in submeshes[i]['vb'][pos_i]['Buffer']), 0.0]
+            positions = submeshes[i].vb[pos_i]['Buffer']
+            bbox_min = positions[:,0:3].min(axis=0).tolist() + [0.0]
+            bbox_max = positions[:,0:3].max(axis=0).tolist() + [0.0]
             bbox_mid = [(bbox_min[0]+bbox_max[0])/2, (bbox_min[1]+bbox_max[1])/2, (bbox_min[2]+bbox_max[2])/2, 0.0]
             bbox['min_x'] = min(bbox['min_x'], bbox_min[0])
             bbox['min_y'] = min(bbox['min_y'], bbox_min[1])
@@ -254,7 +261,7 @@ def create_vpax (submeshes, block_type = 'VPAX'):
             bbox['max_y'] = max(bbox['max_y'], bbox_max[1])
             bbox['max_z'] = max(bbox['max_z'], bbox_max[2])
             vpac_header = b'VPAC\x00\x00\x01\x00' + struct.pack("<4f", *bbox_mid) + struct.pack("<4f", *bbox_min) + struct.pack("<4f", *bbox_max) \
-                + struct.pack("<4I", len(submeshes[i]['vb'][pos_i]['Buffer']), len(submeshes[i]['vb'][pos_i]['Buffer'])*stride, submeshes[i]['fmt_bitmask'], attr_len) \
+                + struct.pack("<4I", len(positions), len(positions)*stride, submeshes[i]['fmt_bitmask'], attr_len) \
                 + struct.pack("<{}I".format(attr_len), *attr_format[:attr_len]) \
                 + struct.pack("<{}I".format(attr_len), *attr_offset[:attr_len]) \
                 + struct.pack("<{}I".format(attr_len), *attr_stride[:attr_len]) \
@@ -263,9 +270,9 @@ def create_vpax (submeshes, block_type = 'VPAX'):
             with io.BytesIO() as vb_stream:
                 vb_stream.write(vpac_header)
                 if stride_semantic == 'vb0 stride':
-                    write_seg_vb_stream(submeshes[i]['vb'], vb_stream, submeshes[i]['fmt'], '0', e = '<', interleave = True)
+                    write_seg_vb_stream(submeshes[i].vb, vb_stream, submeshes[i].fmt, '0', e = '<', interleave = True)
                 else:
-                    write_vb_stream(submeshes[i]['vb'], vb_stream, submeshes[i]['fmt'], e = '<', interleave = True)
+                    write_vb_stream(submeshes[i].vb, vb_stream, submeshes[i].fmt, e = '<', interleave = True)
                 if not block_type == 'VPAU':
                     while vb_stream.tell() % 64 > 0:
                         vb_stream.write(b'\x00')
@@ -280,7 +287,7 @@ def create_vpax (submeshes, block_type = 'VPAX'):
                     vb_data = create_data_blocks (vb_stream.read(), compression_type)
                 vertices_data += struct.pack("<I", vb_stream.tell()) + vb_data
             with io.BytesIO() as ib_stream:
-                write_ib_stream(submeshes[i]['ib'], ib_stream, submeshes[i]['fmt'], e = '<')
+                write_ib_stream(submeshes[i].ib, ib_stream, submeshes[i].fmt, e = '<')
                 ib_stream.seek(0,0)
                 if block_type == 'VPAU':
                     ib_data = ib_stream.read()
@@ -368,27 +375,8 @@ def create_rty3 (rty3_data):
     return(b'RTY3' + struct.pack("<I", len(rty3_block_data)) + rty3_block_data)
 
 def rapid_parse_it3 (f):
-    file_length = f.seek(0,2)
-    f.seek(0,0)
-    contents = {}
-    info_section = ''
-    while f.tell() < file_length:
-        section_info = {}
-        section_info["type"] = f.read(4).decode('ASCII')
-        section_info["size"], = struct.unpack("<I",f.read(4))
-        section_info["section_start_offset"] = f.tell()
-        if section_info["type"] == 'INFO':
-            if info_section != '':
-                contents[info_section]['length'] = section_info["section_start_offset"] - 8 - contents[info_section]['offset']
-            section_info["data"] = parse_info_block(f)
-            info_section = section_info["data"]["name"]
-            contents[section_info["data"]["name"]] = {'offset': section_info["section_start_offset"]-8, 'contents': [], 'offsets': []}
-        else:
-            contents[info_section]['contents'].append(section_info["type"])
-            contents[info_section]['offsets'].append(section_info["section_start_offset"])
-        f.seek((section_info["section_start_offset"] + section_info["size"]), 0) # Move forward to the next section
-    contents[info_section]['length'] = f.tell() - contents[info_section]['offset']
-    return(contents)
+    with It3Index(f) as it3_index:
+        return(it3_index.nodes())
 
 def return_rty2_material(f, it3_section):
     f.seek(it3_section['offset'])
@@ -418,9 +406,18 @@ def return_vpau_bitmask(f, it3_section):
             f.seek(size,1)
     return -1
 
+# With --max_ratio, prints how much smaller the section came out than with the default compressor
+def report_ratio_gain (section_name):
+    greedy_size, compressed_size = take_ratio_report()
+    if greedy_size > 0:
+        print("{0}: {1} bytes compressed, {2} bytes with the default compressor ({3:.2f}% smaller)".format(section_name,\
+            compressed_size, greedy_size, 100 * (greedy_size - compressed_size) / greedy_size))
+    return
+
 def process_it3 (it3_filename, import_noskel = False):
-    with open(it3_filename,"rb") as f:
-        it3_contents = rapid_parse_it3 (f)
+    with map_it3(it3_filename) as f:
+        it3_index = It3Index(f)
+        it3_contents = it3_index.nodes()
         # Will read data from JSON file, or load original data from the mdl file if JSON is missing
         try:
             material_struct = read_struct_from_json(it3_filename[:-4] + '/materials_metadata.json')
@@ -433,19 +430,13 @@ def process_it3 (it3_filename, import_noskel = False):
                 mat4 = []
                 mat6 = []
                 rty2 = {}
-                f.seek(it3_contents[section]['offset'])
-                while f.tell() < it3_contents[section]['offset']+it3_contents[section]['length']:
-                    section_info = {}
-                    section_info["type"] = f.read(4).decode('ASCII')
-                    section_info["size"], = struct.unpack("<I",f.read(4))
+                for section_info in it3_index.find(['MAT4', 'MAT6', 'RTY2'], section):
                     if (section_info["type"] == 'MAT4'):
-                        mat4 = parse_mat4_block(f)
+                        mat4 = section_info["data"]
                     elif (section_info["type"] == 'MAT6'):
-                        mat6 = parse_mat6_block(f)
+                        mat6 = section_info["data"]
                     elif (section_info["type"] == 'RTY2'):
-                        rty2 = parse_rty2_block(f)
-                    else:
-                        f.seek(section_info["size"],1)
+                        rty2 = section_info["data"]
                 mats = {}
                 for i in range(len(mat4)):
                     material_name = mat4[i].pop('material_name')
@@ -504,10 +495,8 @@ def process_it3 (it3_filename, import_noskel = False):
                 for j in range(len(submeshfiles)):
                     print("Reading submesh {0}...".format(submeshfiles[j]))
                     try:
-                        fmt = read_fmt(submeshfiles[j] + '.fmt')
-                        ib = read_ib(submeshfiles[j] + '.ib', fmt)
-                        ib = [[x[0],x[2],x[1]] for x in ib] # Swap DirectX triangles back to OpenGL
-                        vb = read_vb(submeshfiles[j] + '.vb', fmt)
+                        # Swap DirectX triangles back to OpenGL
+                        submesh = read_mesh_buffer(submeshfiles[j], swap_winding = True, use_mmap = True, use_cache = mesh_cache)
                         vgmap = read_struct_from_json(submeshfiles[j] + '.vgmap')
                         if os.path.exists(fmt_bitmask_file):
                             fmt_bitmask = json.loads(open(fmt_bitmask_file,'rb').read())['fmt_bitmask']
@@ -526,7 +515,8 @@ def process_it3 (it3_filename, import_noskel = False):
                             else:
                                 input("Press Enter to abort.")
                                 raise
-                        submeshes.append({'fmt': fmt, 'ib': ib, 'vb': vb, 'vgmap': vgmap, 'material': material, 'fmt_bitmask': fmt_bitmask})
+                        submesh.extra.update({'vgmap': vgmap, 'material': material, 'fmt_bitmask': fmt_bitmask})
+                        submeshes.append(submesh)
                     except FileNotFoundError:
                         print("Submesh {0} not found, skipping...".format(submeshfiles[j]))
                         continue
@@ -534,11 +524,11 @@ def process_it3 (it3_filename, import_noskel = False):
                     # Insert an empty mesh
                     if block_type in ['VPA9', 'VPAX', 'VPAU', 'VP11']:
                         fmt = make_fmt(default_fmt_bitmask, {'VPA9':1, 'VPAX':1, 'VPAU': 1, 'VP11':2}[block_type])
-                        submeshes.append({'fmt': fmt, 'ib': [],\
-                        'vb': read_vb_stream(b''.join([b'\x00' for _ in range(int(fmt['stride'])*3)]), fmt),\
-                        'vgmap': {section:0},\
-                        'material': {"material_name": "", "MATM_flags": 65793, "MATE_flags": 65793,\
-                            "unk0": [28,0,0,0,0,0,0], "parameters": [], "textures": []}})
+                        submeshes.append(MeshBuffer(fmt, numpy.zeros((0,3), dtype = int),\
+                        read_vb_stream(b''.join([b'\x00' for _ in range(int(fmt['stride'])*3)]), fmt, as_arrays = True),\
+                        vgmap = {section:0},\
+                        material = {"material_name": "", "MATM_flags": 65793, "MATE_flags": 65793,\
+                            "unk0": [28,0,0,0,0,0,0], "parameters": [], "textures": []}))
                     else: # VPA7 / VPA8
                         fmt = make_vpa8_fmt()
                         submeshes.append({'fmt': fmt, 'ib': [[0,0,0]],\
@@ -613,6 +603,7 @@ def process_it3 (it3_filename, import_noskel = False):
                     else:
                         new_it3 += section_info["type"].encode() + struct.pack("<I", section_info["size"]) \
                             + f.read(section_info["size"])
+                report_ratio_gain(section)
             elif section in to_process_tex: 
                 f.seek(it3_contents[section]['offset'])
                 while f.tell() < it3_contents[section]['offset']+it3_contents[section]['length']:
@@ -641,21 +632,23 @@ def process_it3 (it3_filename, import_noskel = False):
                 new_itp = create_texi (texture, it3_filename[:-4] + '/textures', use_alpha, compression_type)
                 if new_itp != False:
                     print("Importing {0}.".format(texture))
+                    report_ratio_gain(texture)
                     new_it3 += new_itp
                 else:
                     print("Unable to import {}.".format(texture))
-        # Instead of overwriting backups, it will just tag a number onto the end
-        backup_suffix = ''
+    # The map of the IT3 is closed by now, the file cannot be overwritten while it is mapped (on Windows)
+    # Instead of overwriting backups, it will just tag a number onto the end
+    backup_suffix = ''
+    if os.path.exists(it3_filename + '.bak' + backup_suffix):
+        backup_suffix = '1'
         if os.path.exists(it3_filename + '.bak' + backup_suffix):
-            backup_suffix = '1'
-            if os.path.exists(it3_filename + '.bak' + backup_suffix):
-                while os.path.exists(it3_filename + '.bak' + backup_suffix):
-                    backup_suffix = str(int(backup_suffix) + 1)
-            shutil.copy2(it3_filename, it3_filename + '.bak' + backup_suffix)
-        else:
-            shutil.copy2(it3_filename, it3_filename + '.bak')
-        with open(it3_filename,'wb') as f2:
-            f2.write(new_it3)
+            while os.path.exists(it3_filename + '.bak' + backup_suffix):
+                backup_suffix = str(int(backup_suffix) + 1)
+        shutil.copy2(it3_filename, it3_filename + '.bak' + backup_suffix)
+    else:
+        shutil.copy2(it3_filename, it3_filename + '.bak')
+    with open(it3_filename,'wb') as f2:
+        f2.write(new_it3)
 
 if __name__ == "__main__":
     # Set current directory
@@ -669,11 +662,25 @@ if __name__ == "__main__":
         import argparse
         parser = argparse.ArgumentParser()
         parser.add_argument('-n', '--import_noskel', help="Import physics meshes (RTY2 material == 8) from ib/vb instead of it3", action="store_true")
+        parser.add_argument('-j', '--jobs', help="Number of processes to use for compression (0 = all cores, default 1)", type=int, default=1)
+        parser.add_argument('-s', '--store', help="Store data without compression (fast test builds)", action="store_true")
+        parser.add_argument('-m', '--max_ratio', help="Compress as small as possible (very slow)", action="store_true")
+        parser.add_argument('-u', '--no_cache', help="Do not reuse or save compressed blocks and decoded meshes between runs", action="store_true")
         parser.add_argument('it3_filename', help="Name of it3 file to import into (required).")
         args = parser.parse_args()
+        set_compression_workers(args.jobs)
+        if args.store == True:
+            set_compression_level(0)
+        elif args.max_ratio == True:
+            set_compression_level(2)
+        if args.no_cache == False:
+            set_block_cache(os.path.abspath(compression_cache_folder), compression_cache_max_size)
+        else:
+            mesh_cache = False
         if os.path.exists(args.it3_filename) and args.it3_filename[-4:].lower() == '.it3':
             process_it3(args.it3_filename, import_noskel = args.import_noskel)
     else:
+        set_block_cache(os.path.abspath(compression_cache_folder), compression_cache_max_size)
         it3_files = glob.glob('*.it3')
         for i in range(len(it3_files)):
             process_it3(it3_files[i])
@@ -324,9 +324,10 @@ def write_glTF(filename, it3_contents, mesh_struct, skel_struct, flip_axis = Tru
 
 def process_it3 (it3_filename, flip_axis = True, render_non_skel_meshes = False, overwrite = False):
     print("Processing {0}...".format(it3_filename))
-    with open(it3_filename, "rb") as f:
+    with map_it3(it3_filename) as f:
         it3_contents = parse_it3(f)
         it3_contents, mesh_struct = obtain_mesh_data(f, it3_contents, it3_filename, preserve_gl_order = False, trim_for_gpu = True)
+        it3_contents.load(['INFO', 'CHID', 'MAT4', 'MAT6', 'RTY2'])
     skel_struct = obtain_skeleton_data(it3_contents, it3_filename, flip_axis = flip_axis)
     if os.path.exists(it3_filename[:-4] + '.gltf') and (overwrite == False):
         if str(input(it3_filename[:-4] + ".gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
@@ -349,8 +350,10 @@ if __name__ == "__main__":
         parser.add_argument('-n', '--no_axis_flip', help="Keep Y up", action="store_false")
         parser.add_argument('-r', '--render_no_skel', help="Render meshes without weights", action="store_true")
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
+        parser.add_argument('-j', '--jobs', help="Number of processes to use for decompression (0 = all cores, default 1)", type=int, default=1)
         parser.add_argument('it3_filename', help="Name of it3 file to process.")
         args = parser.parse_args()
+        set_decompression_workers(args.jobs)
         if os.path.exists(args.it3_filename) and args.it3_filename[-4:].lower() == '.it3':
             process_it3(args.it3_filename, flip_axis = args.no_axis_flip,\
                 render_non_skel_meshes = args.render_no_skel, overwrite = args.overwrite)